@@ -0,0 +1,68 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Uploads many small files into one device folder and reports the cost per file as the folder grows, together
+with the number of folder listings. With the cached folder updated in place both stay flat; a relist after
+every upload makes the per file cost grow with the folder.
+
+    python3 benchmarks/bench_bulk_upload.py [-d device] [-n files] [-s size] "/Internal storage/Download"
+'''
+
+import os
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from device import RefreshCounter, call, local_file, open_device, remove_tree, report, timed
+
+BATCH = 500
+
+
+def main():
+    parser = OptionParser(usage="%prog [-d device] [-n files] [-s size] [-k] device_folder")
+    parser.add_option("-d", "--device", dest="device", default="0", help="Device index or vendor:product")
+    parser.add_option("-n", "--files", dest="files", type="int", default=5000, help="Files to upload")
+    parser.add_option("-s", "--size", dest="size", type="int", default=4096, help="Size of each file")
+    parser.add_option("-k", "--keep", action="store_true", dest="keep", default=False,
+                      help="Keep the uploaded files on the device")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("A device folder is required")
+    mtp = open_device(options.device)
+    target = os.path.join(args[0], 'pymtpfs-bench-upload')
+    if not mtp.get_path(target) is None or not mtp.mkdir(target):
+        mtp.close()
+        raise SystemExit('Could not create %s (remove it if it is left over from an earlier run)' % (target,))
+    tempdir = tempfile.mkdtemp(prefix='pymtpfs-bench')
+    try:
+        source = local_file(tempdir, 'source', options.size)
+        total = 0.0
+        with RefreshCounter() as refreshes:
+            for first in range(0, options.files, BATCH):
+                count = min(BATCH, options.files - first)
+                relists = refreshes.count
+                seconds, errors = timed(upload, mtp, source, target, first, count)
+                total += seconds
+                if errors > 0:
+                    print("%d uploads failed" % (errors,))
+                report("files %d-%d (%d listings)" % (first, first + count - 1, refreshes.count - relists),
+                       seconds, count)
+        report("total", total, options.files)
+        listed = call(mtp, mtp.get_path(target).object_count)
+        print("%d files in %s, %d folder listings" % (listed, target, refreshes.count))
+    finally:
+        shutil.rmtree(tempdir)
+        if not options.keep:
+            remove_tree(mtp, target)
+        mtp.close()
+
+
+def upload(mtp, source, target, first, count):
+    errors = 0
+    for i in range(first, first + count):
+        if call(mtp, mtp.copy_to, source, os.path.join(target, 'file%06d.bin' % (i,))) != 0:
+            errors += 1
+    return errors
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Copies files within the device with MTP.copy_object (CopyObject, the data stays on the device) and with the
+fallback that pulls the file to the host and sends it back, for a few file sizes.
+
+    python3 benchmarks/bench_copy_object.py [-d device] [-s MiB,MiB,...] "/Internal storage/Download"
+'''
+
+import os
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from device import call, local_file, open_device, remove_tree, timed
+from mtp import LIBMTP_DEVICECAP_CopyObject
+
+
+def copy_by_transfer(mtp, source, target, tempdir):
+    ''' What copy_object falls back to without CopyObject: download to a local file and upload that '''
+    fh, localcopy = tempfile.mkstemp(dir=tempdir)
+    try:
+        err = mtp.copy_from(source, fh)
+        if err == 0:
+            err = call(mtp, mtp.copy_to, fh, target)
+        return err
+    finally:
+        os.close(fh)
+        os.remove(localcopy)
+
+
+def main():
+    parser = OptionParser(usage="%prog [-d device] [-s sizes] device_folder")
+    parser.add_option("-d", "--device", dest="device", default="0", help="Device index or vendor:product")
+    parser.add_option("-s", "--sizes", dest="sizes", default="1,16,128", help="File sizes in MiB, comma separated")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("A device folder is required")
+    mtp = open_device(options.device)
+    target = os.path.join(args[0], 'pymtpfs-bench-copy')
+    if not mtp.get_path(target) is None or not mtp.mkdir(target):
+        mtp.close()
+        raise SystemExit('Could not create %s (remove it if it is left over from an earlier run)' % (target,))
+    tempdir = tempfile.mkdtemp(prefix='pymtpfs-bench')
+    try:
+        if not mtp.supports(LIBMTP_DEVICECAP_CopyObject):
+            print("The device does not support CopyObject, copy_object times the fallback as well")
+        print("%8s %14s %14s" % ("MiB", "copy_object", "via host"))
+        for mib in [int(size) for size in options.sizes.split(',')]:
+            source = os.path.join(target, 'source%d.bin' % (mib,))
+            err = call(mtp, mtp.copy_to, local_file(tempdir, 'source', mib * 1024 * 1024), source)
+            if err != 0:
+                raise SystemExit('Upload of %s failed (%d)' % (source, err))
+            device_seconds, err = timed(mtp.copy_object, source, os.path.join(target, 'copy%d.bin' % (mib,)))
+            if err != 0:
+                print("copy_object of %d MiB failed (%d)" % (mib, err))
+            host_seconds, err = timed(copy_by_transfer, mtp, source, os.path.join(target, 'host%d.bin' % (mib,)),
+                                      tempdir)
+            if err != 0:
+                print("Copy through the host of %d MiB failed (%d)" % (mib, err))
+            print("%8d %12.3f s %12.3f s" % (mib, device_seconds, host_seconds))
+    finally:
+        shutil.rmtree(tempdir)
+        remove_tree(mtp, target)
+        mtp.close()
+
+
+if __name__ == '__main__':
+    main()
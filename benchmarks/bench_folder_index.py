@@ -0,0 +1,76 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Resolves every child of a synthetic folder through the MTPFolder name index (find_file and the off-executor
+cached_child) and compares it with the linear utf8() scan the index replaced, timed on a sample.
+Needs the pymtpfs dependencies (libmtp included) but no device.
+
+    python3 benchmarks/bench_folder_index.py [children]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pymtpfs'))
+
+from mtp import MTPFolder, utf8
+
+LINEAR_SAMPLE = 50  # The linear scan is quadratic over the whole folder, so only this many names are timed
+
+
+def synthetic_folder(count):
+    folder = MTPFolder(path='/Internal storage/DCIM/Camera', id=1, storageid=1, folderid=0, is_refresh=False)
+    folder.must_refresh = False
+    now = int(time.time())
+    for i in range(count):
+        folder.add_child(i + 2, 1, 'IMG_%08d.jpg' % (i,), False, 3 * 1024 * 1024, now - i, replace=False)
+    return folder
+
+
+def linear_find(files, name):
+    for f in files:
+        if utf8(f.get_name()) == utf8(name):
+            return f
+    return None
+
+
+def report(label, seconds, lookups):
+    print("%-28s %10.3f ms %10.2f us/lookup" % (label, seconds * 1000, seconds * 1e6 / lookups))
+
+
+def main(count):
+    names = ['IMG_%08d.jpg' % (i,) for i in range(count)]
+    start = time.perf_counter()
+    folder = synthetic_folder(count)
+    print("%d children listed in %.3f ms" % (count, (time.perf_counter() - start) * 1000))
+
+    start = time.perf_counter()
+    for name in names:
+        if folder.find_file(name) is None:
+            raise AssertionError(name)
+    report("find_file (first pass)", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    for name in names:
+        folder.find_file(name)
+    report("find_file", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    for name in names:
+        known, entry = folder.cached_child(name)
+        if not known or entry is None:
+            raise AssertionError(name)
+    report("cached_child", time.perf_counter() - start, count)
+
+    files = folder.get_files()
+    sample = names[::max(1, count // LINEAR_SAMPLE)]
+    start = time.perf_counter()
+    for name in sample:
+        linear_find(files, name)
+    seconds = time.perf_counter() - start
+    report("linear scan (sampled)", seconds, len(sample))
+    print("linear scan over all %d children: ~%.1f s" % (count, seconds * count / len(sample)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,70 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Per file cost of rsync -a onto a mounted device, separating the copy from the modification time updates
+that utimens serves. Needs a running pymtpfs mount and rsync. Three passes over the same local tree:
+
+  copy   rsync -a of new files (create, write, utimens, rename per file)
+  touch  touch -d on every file of the mount (utimens alone)
+  times  rsync -a --size-only after only the local modification times changed (utimens alone, from rsync)
+
+    python3 benchmarks/bench_rsync_times.py [-n files] [-s size] /mnt/phone/Internal\\ storage/Download
+'''
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+
+def timed(*args):
+    start = time.perf_counter()
+    subprocess.check_call(args)
+    return time.perf_counter() - start
+
+
+def report(label, seconds, count):
+    print("%-30s %9.3f s %9.2f ms/file" % (label, seconds, seconds * 1000 / max(count, 1)))
+
+
+def main():
+    parser = OptionParser(usage="%prog [-n files] [-s size] folder_on_mount")
+    parser.add_option("-n", "--files", dest="files", type="int", default=200, help="Files to copy")
+    parser.add_option("-s", "--size", dest="size", type="int", default=1024 * 1024, help="Size of each file")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("A folder on a pymtpfs mount is required")
+    target = os.path.join(args[0], 'pymtpfs-bench-rsync')
+    if os.path.exists(target):
+        raise SystemExit('%s exists (remove it if it is left over from an earlier run)' % (target,))
+    source = tempfile.mkdtemp(prefix='pymtpfs-bench')
+    try:
+        data = os.urandom(options.size)
+        for i in range(options.files):
+            with open(os.path.join(source, 'file%05d.bin' % (i,)), 'wb') as f:
+                f.write(data)
+        seconds = timed('rsync', '-a', source + os.sep, target)
+        report("copy (rsync -a)", seconds, options.files)
+
+        names = sorted(os.listdir(target))
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 86400))
+        seconds = timed('touch', '-d', stamp, *[os.path.join(target, name) for name in names])
+        report("touch -d", seconds, len(names))
+
+        mtime = time.time() - 2 * 86400
+        for name in os.listdir(source):
+            os.utime(os.path.join(source, name), (mtime, mtime))
+        seconds = timed('rsync', '-a', '--size-only', source + os.sep, target)
+        report("times (rsync -a --size-only)", seconds, options.files)
+        wrong = [name for name in names if abs(os.stat(os.path.join(target, name)).st_mtime - mtime) > 2]
+        if len(wrong) > 0:
+            print("%d files on the mount did not get the new modification time" % (len(wrong),))
+    finally:
+        shutil.rmtree(source)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Incremental sync of a 100k file tree of which 1% changed.
+
+Without a device the device side is a synthetic listing (MTPFolder objects filled in memory) and only the
+plan is timed: comparing 100k listed entries with 100k local files must cost one stat per local file and no
+device call. With -D a real device folder is mirrored into a local directory (the first run copies
+everything), 1% of the local copies are then made stale and the timed second sync must copy only those.
+
+    python3 benchmarks/bench_sync.py [-n files]
+    python3 benchmarks/bench_sync.py -D "/Internal storage/DCIM" -l ~/dcim-mirror [-d device]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pymtpfs'))
+
+from mtp import MTPFolder
+from sync import MTPSync, DOWNLOAD
+
+FILES_PER_FOLDER = 1000
+CHANGED = 0.01
+
+
+class ListedDevice:
+    ''' Stands in for MTP when planning against a synthetic listing: get_path walks the in-memory folders '''
+
+    def __init__(self, root):
+        self.root = root
+        self.executor = None  # Every folder is listed, nothing may go to the device
+
+    def get_path(self, path):
+        entry = self.root
+        for name in [comp for comp in path.split(os.sep) if comp != ''][1:]:
+            child = entry.find_directory(name)
+            entry = child if not child is None else entry.find_file(name)
+            if entry is None:
+                return None
+        return entry
+
+
+def listed(folder):
+    folder.must_refresh = False
+    folder.loaded = True
+    return folder
+
+
+def synthetic_tree(local, count):
+    ''' A device listing of count files and a local copy of it (sparse files) with CHANGED of them differing '''
+    root = listed(MTPFolder(path='/Phone', id=1, storageid=1, folderid=0, is_refresh=False))
+    now = int(time.time())
+    nextid = 2
+    changed = 0
+    for first in range(0, count, FILES_PER_FOLDER):
+        name = 'folder%03d' % (first // FILES_PER_FOLDER,)
+        os.mkdir(os.path.join(local, name))
+        folder = listed(root.child(root.add_child(nextid, 1, name, True, 0, now, replace=False)))
+        nextid += 1
+        for i in range(first, min(first + FILES_PER_FOLDER, count)):
+            filename = 'IMG_%08d.jpg' % (i,)
+            size, mtime = 1024 * 1024 + i, now - i
+            folder.add_child(nextid, folder.get_id(), filename, False, size, mtime, replace=False)
+            nextid += 1
+            path = os.path.join(local, name, filename)
+            with open(path, 'wb') as f:
+                if i % int(1 / CHANGED) == 0:
+                    size += 1
+                    changed += 1
+                f.truncate(size)
+            os.utime(path, (mtime, mtime))
+    return root, changed
+
+
+def plan_synthetic(count):
+    local = tempfile.mkdtemp(prefix='pymtpfs-bench-sync')
+    try:
+        start = time.perf_counter()
+        root, changed = synthetic_tree(local, count)
+        print("Built %d listed and %d local files in %.1f s" % (count, count, time.perf_counter() - start))
+        sync = MTPSync(ListedDevice(root), '/Phone', local, DOWNLOAD)
+        for run in range(3):
+            start = time.perf_counter()
+            plan = sync.plan()
+            seconds = time.perf_counter() - start
+            print("plan %d: %.3f s (%.1f us/file), %d changed, %d unchanged, %d bytes to copy" %
+                  (run + 1, seconds, seconds * 1e6 / count, len(plan.updated), plan.unchanged, plan.bytes))
+            if len(plan.updated) != changed or len(plan.added) != 0:
+                raise AssertionError("Expected %d changed files" % (changed,))
+    finally:
+        shutil.rmtree(local)
+
+
+def sync_device(options):
+    from device import open_device
+    mtp = open_device(options.device)
+    try:
+        sync = MTPSync(mtp, options.device_folder, options.local, DOWNLOAD)
+        report = sync.run()
+        print("Initial sync: %s" % (report,))
+        files = []
+        for dirpath, _, filenames in os.walk(options.local):
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+        stale = random.sample(files, max(1, int(len(files) * CHANGED)))
+        for path in stale:
+            st = os.stat(path)
+            os.utime(path, (st.st_atime, st.st_mtime - 3600))
+        start = time.perf_counter()
+        plan = sync.plan()
+        print("Plan of %d files: %.3f s, %d to copy" % (len(files), time.perf_counter() - start,
+                                                        len(plan.added) + len(plan.updated)))
+        report = sync.run()
+        print("Incremental sync of %d stale files: %s" % (len(stale), report))
+        if report.copied != len(stale):
+            print("Expected %d copies" % (len(stale),))
+    finally:
+        mtp.close()
+
+
+def main():
+    parser = OptionParser(usage="%prog [-n files] | -D device_folder -l local_dir [-d device]")
+    parser.add_option("-n", "--files", dest="files", type="int", default=100000, help="Synthetic tree size")
+    parser.add_option("-D", "--device-folder", dest="device_folder", default=None,
+                      help="Sync this device folder instead of a synthetic listing")
+    parser.add_option("-l", "--local", dest="local", default=None, help="Local mirror of the device folder")
+    parser.add_option("-d", "--device", dest="device", default="0", help="Device index or vendor:product")
+    (options, args) = parser.parse_args()
+    if options.device_folder is None:
+        plan_synthetic(options.files)
+    elif options.local is None:
+        parser.error("A device folder needs a local mirror directory (-l)")
+    else:
+        sync_device(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Setup shared by the benchmarks that talk to a connected MTP device. Benchmark folders are created below a
+folder given on the command line (a device path such as "/Internal storage/Download") and removed afterwards.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pymtpfs'))
+
+from mtp import MTP, MTPFolder
+from executor import FOREGROUND
+
+
+def open_device(device=0):
+    ''' An MTP with the device (index or vendor:product as for pymtpfs -d) open '''
+    mtp = MTP()
+    if mtp.count() == 0:
+        raise SystemExit('No MTP devices connected')
+    if not mtp.open(device):
+        raise SystemExit('Could not open MTP device %s' % (device,))
+    return mtp
+
+
+def call(mtp, f, *args, **kwargs):
+    ''' Run f on the device executor as a FUSE request would '''
+    return mtp.executor.call(f, *args, priority=FOREGROUND, **kwargs)
+
+
+def local_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def remove_tree(mtp, path):
+    ''' Delete path and everything below it from the device '''
+    entry = mtp.get_path(path)
+    if entry is None:
+        return
+    if entry.is_directory():
+        for child in call(mtp, entry.get_files):
+            mtp.rm(child.get_path())
+        for child in call(mtp, entry.get_directories):
+            remove_tree(mtp, child.get_path())
+        mtp.rmdir(path)
+    else:
+        mtp.rm(path)
+
+
+class RefreshCounter:
+    ''' Counts folder listings (LIBMTP_Get_Files_And_Folders calls) while active '''
+
+    def __init__(self):
+        self.count = 0
+        self.original = MTPFolder.refresh
+
+    def __enter__(self):
+        counter = self
+
+        def refresh(folder, from_device=False):
+            counter.count += 1
+            return counter.original(folder, from_device)
+
+        MTPFolder.refresh = refresh
+        return self
+
+    def __exit__(self, *exc):
+        MTPFolder.refresh = self.original
+
+
+def report(label, seconds, count):
+    print("%-36s %9.3f s %9.2f ms/file" % (label, seconds, seconds * 1000 / max(count, 1)))
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return time.perf_counter() - start, result
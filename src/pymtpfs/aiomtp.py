@@ -0,0 +1,125 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+asyncio facade over MTP. Device calls are submitted to the MTP device executor (the single thread that owns
+the libmtp device) and awaited, so they never block the event loop.
+'''
+
+import asyncio
+import os
+
+from executor import METADATA, FOREGROUND, BACKGROUND
+from mtp import MTP, MTPTransferProgress
+
+
+class AsyncMTPTransfer:
+    '''
+    A running copy_from/copy_to. Await it for the result (0 or an errno value), call cancel() to stop it and
+    iterate it with async for to receive (sent, total) progress updates until the transfer ends.
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.updates = asyncio.Queue()
+        self.progress = MTPTransferProgress(on_progress=self.__on_progress)
+        self.future = None
+
+    def __on_progress(self, sent, total):
+        # Called on the device executor or the thread driving a chunked download
+        self.loop.call_soon_threadsafe(self.updates.put_nowait, (sent, total))
+
+    def start(self, future):
+        self.future = future
+        self.future.add_done_callback(lambda future: self.updates.put_nowait(None))
+        return self
+
+    def cancel(self):
+        ''' Stop the transfer at the next progress update, or before it starts if it is still queued '''
+        self.progress.cancel()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def __aiter__(self):
+        return self.__iterate()
+
+    async def __iterate(self):
+        while True:
+            update = await self.updates.get()
+            if update is None:
+                return
+            yield update
+
+
+class AsyncMTP:
+    '''
+    Awaitable versions of the MTP path operations. Wraps an existing MTP instance, or creates one from the
+    MTP constructor arguments (which enumerates the devices, so do that before the event loop is busy).
+    '''
+
+    def __init__(self, mtp=None, **kwargs):
+        self.mtp = MTP(**kwargs) if mtp is None else mtp
+
+    def __submit(self, f, *args, priority=METADATA, **kwargs):
+        return asyncio.wrap_future(self.mtp.executor.submit(f, *args, priority=priority, **kwargs))
+
+    async def open(self, devno, must_refresh=False):
+        return await self.__submit(self.mtp.open, devno, must_refresh)
+
+    async def close(self):
+        return await self.__submit(self.mtp.close)
+
+    async def get_path(self, path):
+        known, entry = self.mtp.find_cached(path)
+        if known:
+            return entry
+        return await self.__submit(self.mtp.get_path, path)
+
+    async def iterdir(self, path):
+        ''' Async iterator over the MTPFolder/MTPFile entries of a directory '''
+        folder = await self.get_path(path)
+        if folder is None:
+            raise FileNotFoundError(path)
+        if not folder.is_directory():
+            raise NotADirectoryError(path)
+        if folder.must_refresh:
+            await self.__submit(folder.refresh)
+        for entry in list(folder.get_directories()) + list(folder.get_files()):
+            yield entry
+
+    async def mkdir(self, path):
+        return await self.__submit(self.mtp.mkdir, path)
+
+    async def rmdir(self, path):
+        return await self.__submit(self.mtp.rmdir, path)
+
+    async def rm(self, path):
+        return await self.__submit(self.mtp.rm, path)
+
+    async def rename(self, oldpath, newpath):
+        return await self.__submit(self.mtp.rename, oldpath, newpath)
+
+    def copy_from(self, source, target, timeout=None):
+        '''
+        Download source into a local path or file handle. Returns an AsyncMTPTransfer. Chunked downloads are
+        driven from a worker thread so that other device calls can run between the chunks.
+        '''
+        loop = asyncio.get_running_loop()
+        transfer = AsyncMTPTransfer(loop)
+        return transfer.start(loop.run_in_executor(None, lambda: self.mtp.copy_from(source, target, timeout,
+                                                                                    progress=transfer.progress)))
+
+    def copy_to(self, source, target, timeout=None, timestamp=None):
+        ''' Upload a local path or file handle to target. Returns an AsyncMTPTransfer '''
+        transfer = AsyncMTPTransfer(asyncio.get_running_loop())
+        if type(source) != int and not os.path.exists(source):
+            raise FileNotFoundError(source)
+        return transfer.start(self.__submit(self.mtp.copy_to, source, target, timeout, timestamp,
+                                            progress=transfer.progress, priority=BACKGROUND))
+
+    async def read(self, source, offset, size):
+        ''' Partial read, see MTP.read '''
+        return await self.__submit(self.mtp.read, source, offset, size, priority=FOREGROUND)
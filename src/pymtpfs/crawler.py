@@ -0,0 +1,115 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Background crawler that walks every MTP storage breadth first and fills the path caches
+(MTPStorage.contents) ahead of user requests.
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+from executor import PREFETCH
+from mtp import utf8
+
+
+class MTPCrawlProgress:
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.folders_done = 0
+        self.folders_queued = 0
+        self.objects = 0
+        self.busy = 0.0
+
+    def eta(self):
+        ''' Estimated seconds until the crawl completes, based on the average time spent listing a folder '''
+        if self.folders_done == 0:
+            return None
+        return (self.busy / self.folders_done) * self.folders_queued
+
+    def __str__(self):
+        elapsed = (self.finished if not self.finished is None else time.time()) - self.started
+        if not self.finished is None:
+            return "Crawl complete: %d folders, %d objects in %.1fs" % (self.folders_done, self.objects, elapsed)
+        eta = self.eta()
+        return "Crawling: %d folders done, %d queued, %d objects, %.1fs elapsed, ETA %s" % \
+               (self.folders_done, self.folders_queued, self.objects, elapsed,
+                '?' if eta is None else '%.0fs' % (eta,))
+
+
+class MTPCrawler(threading.Thread):
+    '''
+    Lists every folder of every storage of an open MTP device in a daemon thread. Each folder listing
+    is queued on the device executor at prefetch priority so user requests are always served first.
+    '''
+
+    def __init__(self, mtp, report_interval=10, on_progress=None):
+        threading.Thread.__init__(self, name="pymtpfs-crawler")
+        self.daemon = True
+        self.mtp = mtp
+        self.report_interval = report_interval
+        self.on_progress = on_progress
+        self.progress = MTPCrawlProgress()
+        self.stopped = False
+        self.log = logging.getLogger("pymtpfs")
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        try:
+            while not self.stopped and not self.__crawl():
+                if self.mtp.open_device is None:
+                    return
+                self.log.info("Device storages changed during crawl, restarting")
+            self.progress.finished = time.time()
+            self.__report()
+        except:
+            self.log.exception("Crawler failed")
+
+    def __crawl(self):
+        ''' Returns False if the device was reopened (storages replaced) while crawling '''
+        self.progress = MTPCrawlProgress()
+        storages = dict(self.mtp.storages)
+        queue = deque()
+        for storage in storages.values():
+            if not storage.root is None:
+                queue.append((storage, storage.root))
+        self.progress.folders_queued = len(queue)
+        last_report = time.time()
+        while len(queue) > 0 and not self.stopped:
+            storage, folder = queue.popleft()
+            start = time.time()
+            directories = self.mtp.executor.call(self.__list, storage, folder, priority=PREFETCH)
+            if directories is None:
+                return False
+            self.progress.objects += folder.object_count()
+            for dir in directories:
+                queue.append((storage, dir))
+            self.progress.busy += time.time() - start
+            self.progress.folders_done += 1
+            self.progress.folders_queued = len(queue)
+            if time.time() - last_report >= self.report_interval:
+                self.__report()
+                last_report = time.time()
+        return True
+
+    def __list(self, storage, folder):
+        '''
+        Runs on the device executor, the only thread that touches the path caches. Returns None if the
+        storages were replaced
+        '''
+        if self.mtp.open_device is None or self.mtp.storages.get(storage.get_name()) is not storage:
+            return None
+        if folder.must_refresh:
+            folder.refresh()
+        directories = folder.get_directories()
+        for dir in directories:
+            storage.contents[utf8(dir.get_path())] = dir
+        return directories
+
+    def __report(self):
+        self.log.info(str(self.progress))
+        if not self.on_progress is None:
+            self.on_progress(self.progress)
@@ -0,0 +1,116 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Listens for MTP device events and applies them to the cached storages and folders so that changes made
+on the device itself become visible without relisting.
+'''
+
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeout
+from ctypes import CFUNCTYPE, Structure, byref, c_int, c_long, c_uint32, c_void_p
+
+from executor import METADATA
+
+LIBMTP_EVENT_NONE = 0
+LIBMTP_EVENT_STORE_ADDED = 1
+LIBMTP_EVENT_STORE_REMOVED = 2
+LIBMTP_EVENT_OBJECT_ADDED = 3
+LIBMTP_EVENT_OBJECT_REMOVED = 4
+LIBMTP_EVENT_DEVICE_PROPERTY_CHANGED = 5
+
+EVENT_CB_FUNC_P = CFUNCTYPE(None, c_int, c_int, c_uint32, c_void_p)
+
+
+class timeval(Structure):
+    _fields_ = [('tv_sec', c_long),
+                ('tv_usec', c_long)
+                ]
+
+
+class MTPEventListener(threading.Thread):
+    '''
+    Polls for device events with LIBMTP_Read_Event_Async/LIBMTP_Handle_Events_Timeout_Completed. Waiting for
+    events does not use the device executor; applying an event is queued on it at metadata priority.
+    '''
+
+    def __init__(self, mtp, poll_interval=1):
+        threading.Thread.__init__(self, name="pymtpfs-events")
+        self.daemon = True
+        self.mtp = mtp
+        self.device = mtp.open_device.device
+        self.poll_interval = poll_interval
+        self.stopped = False
+        self.pending = False
+        self.events = []
+        self.callback = EVENT_CB_FUNC_P(self.__event)  # Keep a reference while a read is outstanding
+        self.log = logging.getLogger("pymtpfs")
+
+    def stop(self):
+        self.stopped = True
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def __event(self, ret, event, param, user_data):
+        self.pending = False
+        if ret == 0:
+            self.events.append((event, param))
+        else:
+            self.log.warning("Device event read failed (%d)" % (ret,))
+
+    def run(self):
+        libmtp = self.mtp.libmtp
+        try:
+            libmtp.LIBMTP_Read_Event_Async
+        except AttributeError:
+            self.log.error("libmtp does not support asynchronous events, device changes will not be tracked")
+            return
+        while not self.stopped:
+            if not self.pending:
+                if not self.__locked(lambda: libmtp.LIBMTP_Read_Event_Async(self.device, self.callback, None)):
+                    if not self.stopped:
+                        time.sleep(self.poll_interval)
+                    continue
+                self.pending = True
+            completed = c_int(0)
+            tv = timeval(self.poll_interval, 0)
+            if libmtp.LIBMTP_Handle_Events_Timeout_Completed(byref(tv), byref(completed)) != 0:
+                self.log.error("Error handling device events")
+                time.sleep(self.poll_interval)
+            while len(self.events) > 0 and not self.stopped:
+                event, param = self.events.pop(0)
+                self.__locked(lambda: self.__apply(event, param))
+
+    def __locked(self, f):
+        ''' Run f on the device executor at metadata priority. Returns False if stopped while waiting '''
+        try:
+            future = self.mtp.executor.submit(self.__guarded, f, priority=METADATA)
+        except RuntimeError:
+            return False
+        while True:
+            try:
+                ret = future.result(timeout=self.poll_interval)
+                return ret is None or ret == 0 or ret is True
+            except FutureTimeout:
+                if self.stopped:
+                    future.cancel()
+                    return False
+            except CancelledError:
+                return False
+            except:
+                self.log.exception("Error handling device event")
+                return False
+
+    def __guarded(self, f):
+        if self.stopped or self.mtp.open_device is None:
+            return False
+        return f()
+
+    def __apply(self, event, param):
+        self.log.debug("Device event %d (%d)" % (event, param))
+        if event == LIBMTP_EVENT_OBJECT_ADDED:
+            self.mtp.object_added(param)
+        elif event == LIBMTP_EVENT_OBJECT_REMOVED:
+            self.mtp.object_removed(param)
+        elif event == LIBMTP_EVENT_STORE_ADDED or event == LIBMTP_EVENT_STORE_REMOVED:
+            self.mtp.refresh_storages()
@@ -0,0 +1,117 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Device executor: a single thread that owns the libmtp device. libmtp is not thread safe, so every call
+that talks to the device is queued here while cache-only work stays on the caller's thread.
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Priority classes, highest first
+METADATA = 0  # Lookups, listings and other short metadata operations
+FOREGROUND = 1  # Reads a user is waiting for
+BACKGROUND = 2  # Bulk transfers such as uploads
+PREFETCH = 3  # Crawling and revalidation ahead of user requests
+
+PRIORITY_NAMES = ('metadata', 'foreground', 'background', 'prefetch')
+
+
+class MTPExecutorStats:
+    ''' Counters for one priority class. Wait times are from submission until the call starts running '''
+    __slots__ = ('submitted', 'started', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def wait_average(self):
+        return 0.0 if self.started == 0 else self.wait_total / self.started
+
+
+class MTPExecutor(threading.Thread):
+    '''
+    Runs submitted callables one at a time on its own thread, always taking the oldest call of the highest
+    priority class that has work queued. Long transfers are submitted as a series of chunks by the caller so
+    that higher priority calls can run between them.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="pymtpfs-device")
+        self.daemon = True
+        self.queues = tuple(deque() for _ in PRIORITY_NAMES)
+        self.counters = tuple(MTPExecutorStats() for _ in PRIORITY_NAMES)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.log = logging.getLogger("pymtpfs")
+
+    def submit(self, f, *args, priority=FOREGROUND, **kwargs):
+        future = Future()
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("Device executor stopped")
+            self.queues[priority].append((future, f, args, kwargs, time.time()))
+            self.counters[priority].submitted += 1
+            self.condition.notify()
+        return future
+
+    def call(self, f, *args, priority=FOREGROUND, **kwargs):
+        ''' Run f on the executor and wait for its result. Calls made from the executor itself run inline '''
+        if threading.current_thread() is self:
+            return f(*args, **kwargs)
+        return self.submit(f, *args, priority=priority, **kwargs).result()
+
+    def is_executor_thread(self):
+        return threading.current_thread() is self
+
+    def stats(self):
+        ''' Per priority class name: queue depth, submitted and started calls and wait times in seconds '''
+        with self.condition:
+            return dict((PRIORITY_NAMES[priority], {'queued': len(self.queues[priority]),
+                                                    'submitted': counters.submitted,
+                                                    'started': counters.started,
+                                                    'wait_average': counters.wait_average(),
+                                                    'wait_max': counters.wait_max})
+                        for priority, counters in enumerate(self.counters))
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for queue in self.queues:
+                while len(queue) > 0:
+                    queue.popleft()[0].cancel()
+            self.condition.notify()
+
+    def __next(self):
+        for priority, queue in enumerate(self.queues):
+            if len(queue) > 0:
+                return priority, queue.popleft()
+        return None, None
+
+    def run(self):
+        while True:
+            with self.condition:
+                priority, call = self.__next()
+                while not self.stopped and call is None:
+                    self.condition.wait()
+                    priority, call = self.__next()
+                if self.stopped:
+                    if not call is None:
+                        call[0].cancel()
+                    return
+                future, f, args, kwargs, submitted = call
+                wait = time.time() - submitted
+                counters = self.counters[priority]
+                counters.started += 1
+                counters.wait_total += wait
+                counters.wait_max = max(counters.wait_max, wait)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(f(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
@@ -0,0 +1,64 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Journal of uploads in progress. An upload is recorded before it is sent and removed once the device has the
+complete object, so after a device reset (or a restart, when the journal is kept in a file) it is known which
+uploads were interrupted and whether the device already received them in full.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class MTPUploadJournal:
+    '''
+    Interrupted uploads keyed by device (vendor:product:serial) and target path. Each record holds the
+    expected size, the local source path if there is one and the time the upload started. Kept in memory
+    only unless a path is given, in which case it is rewritten (atomically) on every change.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = {}
+        self.lock = threading.Lock()
+        self.log = logging.getLogger("pymtpfs")
+        if not path is None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    for record in json.load(f):
+                        self.records[(record['device'], record['target'])] = record
+            except (OSError, ValueError, KeyError):
+                self.log.exception("Could not read upload journal %s" % (path,))
+
+    def begin(self, device, target, size, source=None):
+        with self.lock:
+            self.records[(device, target)] = {'device': device, 'target': target, 'size': size,
+                                              'source': source, 'started': time.time()}
+            self.__save()
+
+    def finish(self, device, target):
+        with self.lock:
+            if not self.records.pop((device, target), None) is None:
+                self.__save()
+
+    def get(self, device, target):
+        with self.lock:
+            return self.records.get((device, target))
+
+    def pending(self, device):
+        ''' Records of the uploads to device that were started but never finished '''
+        with self.lock:
+            return [record for (dev, _), record in self.records.items() if dev == device]
+
+    def __save(self):
+        if self.path is None:
+            return
+        temp = self.path + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(list(self.records.values()), f)
+            os.replace(temp, self.path)
+        except OSError:
+            self.log.exception("Could not write upload journal %s" % (self.path,))
@@ -0,0 +1,113 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Persistent SQLite store of MTP folder listings so that a remount can serve the tree immediately
+and revalidate it against the device lazily.
+'''
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from executor import PREFETCH
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS objects (device TEXT, storage_id INTEGER, object_id INTEGER, parent_id INTEGER,
+                                           name TEXT, is_folder INTEGER, size INTEGER, mtime INTEGER,
+                                           PRIMARY KEY (device, storage_id, object_id))''',
+    '''CREATE INDEX IF NOT EXISTS objects_parent ON objects (device, storage_id, parent_id)''',
+    '''CREATE TABLE IF NOT EXISTS folders (device TEXT, storage_id INTEGER, folder_id INTEGER, listed REAL,
+                                           PRIMARY KEY (device, storage_id, folder_id))''',
+)
+
+
+class MTPMetadataCache:
+    '''
+    Folder listings keyed by device (vendor:product:serial), storage id and folder (parent) id.
+    Rows are (object_id, parent_id, name, is_folder, size, mtime).
+    '''
+
+    def __init__(self, path, device):
+        self.path = path
+        self.device = device
+        self.lock = threading.Lock()
+        self.log = logging.getLogger("pymtpfs")
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+
+    def load_folder(self, storageid, folderid):
+        ''' Returns the cached children of a folder or None if the folder was never listed '''
+        with self.lock:
+            listed = self.connection.execute(
+                'SELECT listed FROM folders WHERE device=? AND storage_id=? AND folder_id=?',
+                (self.device, storageid, folderid)).fetchone()
+            if listed is None:
+                return None
+            return self.connection.execute(
+                'SELECT object_id, parent_id, name, is_folder, size, mtime FROM objects '
+                'WHERE device=? AND storage_id=? AND parent_id=?', (self.device, storageid, folderid)).fetchall()
+
+    def save_folder(self, storageid, folderid, rows):
+        try:
+            with self.lock:
+                self.connection.execute('DELETE FROM objects WHERE device=? AND storage_id=? AND parent_id=?',
+                                        (self.device, storageid, folderid))
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(self.device, storageid) + tuple(row) for row in rows])
+                self.connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                                        (self.device, storageid, folderid, time.time()))
+                self.connection.commit()
+        except sqlite3.Error:
+            self.log.exception("Error saving folder %d (storage %d) to %s" % (folderid, storageid, self.path))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MTPRevalidator(threading.Thread):
+    '''
+    Relists folders that were served from the metadata cache. Each relist is queued on the device executor
+    at prefetch priority so it never delays a user request by more than one folder listing.
+    '''
+
+    def __init__(self, mtp):
+        threading.Thread.__init__(self, name="pymtpfs-revalidator")
+        self.daemon = True
+        self.mtp = mtp
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.log = logging.getLogger("pymtpfs")
+
+    def submit(self, folder):
+        with self.condition:
+            self.queue.append(folder)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                folder = self.queue.popleft()
+            try:
+                self.mtp.executor.call(self.__revalidate, folder, priority=PREFETCH)
+            except:
+                self.log.exception("Error revalidating %s" % (folder.get_path(),))
+
+    def __revalidate(self, folder):
+        if not self.stopped and not self.mtp.open_device is None and folder.stale:
+            folder.refresh(from_device=True)
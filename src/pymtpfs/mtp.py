@@ -4,22 +4,25 @@ License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
 Provides a file system based Python ctypes language abstraction for MTP devices
 '''
 
-import codecs
 import copy
 import errno
 import logging
 import os
-import signal
 import stat
 import sys
 import tempfile
+import threading
 import time
 import traceback
+import weakref
+from array import array
 from builtins import FileNotFoundError
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
 from ctypes import *
 from ctypes.util import find_library
 from datetime import datetime
-from io import StringIO
+from functools import wraps
 from typing import Tuple, List, Optional
 
 import lru_py.lru as LRU
@@ -27,7 +30,38 @@ from past.builtins import unicode
 from past.types import long
 from typed_ast._ast3 import Dict
 
+from events import MTPEventListener
+from journal import MTPUploadJournal
+from executor import MTPExecutor, METADATA, FOREGROUND, BACKGROUND
+from metacache import MTPMetadataCache, MTPRevalidator
+from stats import MTPThroughputStats
+from sync import MTPSync, DOWNLOAD, DELETE_KEEP
+from transfer import MTPTransferProgress, PROGRESS_FUNC_P
+from tree import download_tree, upload_tree
+
 PATH_CACHE_SIZE = 10000
+PARTIAL_BLOCK_SIZE = 256 * 1024
+BLOCK_CACHE_SIZE = 64 * 1024 * 1024
+TRANSFER_CHUNK_SIZE = 1024 * 1024  # Downloads are split into GetPartialObject calls of this size
+STREAM_BUFFER_SIZE = 8 * 1024 * 1024  # Written data held for a streaming upload before writers block
+# A transfer is aborted when no bytes move for STALL_TIMEOUT_FACTOR times the time the device needs to move
+# a TRANSFER_CHUNK_SIZE at its measured rate, bounded by these limits (seconds)
+STALL_TIMEOUT_MIN = 15
+STALL_TIMEOUT_MAX = 300
+STALL_TIMEOUT_DEFAULT = 60  # Until a transfer on the device has been measured
+STALL_TIMEOUT_FACTOR = 8
+
+LIBMTP_DEVICECAP_GetPartialObject = 0
+LIBMTP_DEVICECAP_SendPartialObject = 1
+LIBMTP_DEVICECAP_EditObjects = 2
+LIBMTP_DEVICECAP_MoveObject = 3
+LIBMTP_DEVICECAP_CopyObject = 4
+
+LIBMTP_PROPERTY_DateModified = 8
+
+LIBMTP_HANDLER_RETURN_OK = 0
+LIBMTP_HANDLER_RETURN_ERROR = 1
+LIBMTP_HANDLER_RETURN_CANCEL = 2
 
 
 class LIBMTP_device_entry_struct(Structure):
@@ -237,6 +271,59 @@ class MTPType:
         return MTPType.dict.get(ext, MTPType.LIBMTP_FILETYPE_UNKNOWN)
 
 
+class MTPBlockCache:
+    ''' Byte bounded LRU cache of fixed size blocks of device objects keyed by (object id, block number) '''
+
+    def __init__(self, maxsize=BLOCK_CACHE_SIZE, blocksize=PARTIAL_BLOCK_SIZE):
+        self.maxsize = maxsize
+        self.blocksize = blocksize
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, objectid, blockno):
+        with self.lock:
+            data = self.blocks.pop((objectid, blockno), None)
+            if not data is None:
+                self.blocks[(objectid, blockno)] = data
+            return data
+
+    def put(self, objectid, blockno, data):
+        with self.lock:
+            old = self.blocks.pop((objectid, blockno), None)
+            if not old is None:
+                self.size -= len(old)
+            self.blocks[(objectid, blockno)] = data
+            self.size += len(data)
+            while self.size > self.maxsize and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, objectid):
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == objectid]:
+                self.size -= len(self.blocks.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+
+def scheduled(priority):
+    ''' Decorator for MTP methods that talk to the device: they run on the device executor thread in the
+    given priority class '''
+
+    def decorator(f):
+        @wraps(f)
+        def wrapped(self, *args, **kwargs):
+            return self.executor.call(f, self, *args, priority=priority, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
 def utf8(path, logger=None):
     if type(path) == str:
         try:
@@ -249,16 +336,26 @@ def utf8(path, logger=None):
 
 
 class MTPEntry:
+    # One entry exists per cached device object so keep them small: slots, no per-instance logger and
+    # name/datetime derived on demand.
+    __slots__ = ('id', 'folderid', 'storageid', 'path', 'timestamp', 'length')
+    log = logging.getLogger("pymtpfs")
+
     def __init__(self, id, path, folderid=-2, storageid=-2, timestamp=0, length=0):
         self.id = id
         self.folderid = folderid
         self.storageid = storageid
         self.path = path
-        self.name = os.path.split(path)[1]
         self.timestamp = timestamp
-        self.datetime = datetime.fromtimestamp(timestamp)
         self.length = length
-        self.log = logging.getLogger("pymtpfs")
+
+    @property
+    def name(self):
+        return os.path.split(self.path)[1]
+
+    @property
+    def datetime(self):
+        return datetime.fromtimestamp(self.timestamp)
 
     def get_id(self):
         return self.id
@@ -293,6 +390,16 @@ class MTPEntry:
     def get_files(self):
         return ()
 
+    def get_child_attributes(self, sort=None, reverse=False):
+        children = list(self.get_directories()) + list(self.get_files())
+        if sort == 'size':
+            children.sort(key=lambda en: en.get_length(), reverse=reverse)
+        elif sort == 'mtime':
+            children.sort(key=lambda en: en.get_timestamp(), reverse=reverse)
+        elif not sort is None:
+            children.sort(key=lambda en: en.get_name(), reverse=reverse)
+        return ((en.get_name(), en.get_attributes()) for en in children)
+
     def add_file(self, file):
         pass
 
@@ -303,6 +410,8 @@ class MTPEntry:
 
 
 class MTPRefresh:
+    __slots__ = ()
+
     def __init__(self, must_refresh=True):
         self.must_refresh = True
 
@@ -311,6 +420,8 @@ class MTPRefresh:
 
 
 class MTPFile(MTPEntry):
+    __slots__ = ()
+
     def __init__(self, id, path, storageid=-2, folderid=-2, dt=0, length=0):
         MTPEntry.__init__(self, id, path, folderid, storageid, dt, length)
 
@@ -326,64 +437,270 @@ class MTPFile(MTPEntry):
         return "<MTPFile %s>" % self.path
 
 
+class MTPListing:
+    '''
+    Columnar listing of the children of a folder: parallel arrays of object ids, parent ids, sizes,
+    modification times and kinds plus a packed UTF-8 name table. Removed rows are tombstoned until
+    compact() is called. The name lookup index (name hash -> row(s)) is only built on the first lookup.
+    '''
+    __slots__ = ('ids', 'parents', 'sizes', 'mtimes', 'kinds', 'names', 'offsets', 'index', 'live')
+
+    FILE = 0
+    FOLDER = 1
+    REMOVED = 2
+
+    def __init__(self):
+        self.ids = array('q')
+        self.parents = array('q')
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.kinds = array('B')
+        self.names = bytearray()
+        self.offsets = array('q', [0])
+        self.index = None
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def append(self, id, parentid, name, is_folder, size, mtime):
+        row = len(self.ids)
+        self.ids.append(id)
+        self.parents.append(parentid)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.kinds.append(MTPListing.FOLDER if is_folder else MTPListing.FILE)
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.offsets.append(len(self.names))
+        self.live += 1
+        if not self.index is None:
+            self.__index(row, name)
+        return row
+
+    def name(self, row):
+        return self.names[self.offsets[row]:self.offsets[row + 1]].decode('utf-8', 'surrogateescape')
+
+    def is_folder(self, row):
+        return self.kinds[row] == MTPListing.FOLDER
+
+    def find(self, name, kind=None):
+        ''' Row of the live child called name (optionally of the given kind) or -1 '''
+        if self.index is None:
+            self.index = {}
+            for row in self.rows():
+                self.__index(row, self.name(row))
+        rows = self.index.get(hash(name))
+        if rows is None:
+            return -1
+        if type(rows) == int:
+            rows = (rows,)
+        for row in rows:
+            if self.kinds[row] != MTPListing.REMOVED and (kind is None or self.kinds[row] == kind) and \
+                    self.name(row) == name:
+                return row
+        return -1
+
+    def find_id(self, id):
+        row = 0
+        try:
+            while True:
+                row = self.ids.index(id, row)
+                if self.kinds[row] != MTPListing.REMOVED:
+                    return row
+                row += 1
+        except ValueError:
+            return -1
+
+    def remove(self, row):
+        if self.kinds[row] == MTPListing.REMOVED:
+            return
+        if not self.index is None:
+            key = hash(self.name(row))
+            rows = self.index.get(key)
+            if type(rows) == int or rows is None:
+                self.index.pop(key, None)
+            else:
+                rows = tuple(r for r in rows if r != row)
+                self.index[key] = rows[0] if len(rows) == 1 else rows
+        self.kinds[row] = MTPListing.REMOVED
+        self.live -= 1
+
+    def rows(self, kind=None):
+        kinds = self.kinds
+        return (row for row in range(len(kinds)) if kinds[row] != MTPListing.REMOVED and
+                (kind is None or kinds[row] == kind))
+
+    def sorted_rows(self, key='name', reverse=False):
+        ''' Live rows ordered by 'name', 'size' or 'mtime' '''
+        if key == 'size':
+            keyf = self.sizes.__getitem__
+        elif key == 'mtime':
+            keyf = self.mtimes.__getitem__
+        else:
+            keyf = self.name
+        return sorted(self.rows(), key=keyf, reverse=reverse)
+
+    def tombstones(self):
+        return len(self.ids) - self.live
+
+    def compact(self):
+        ''' A copy without the removed rows and a dict mapping old row numbers to new ones '''
+        listing = MTPListing()
+        remap = {}
+        for row in self.rows():
+            remap[row] = listing.append(self.ids[row], self.parents[row], self.name(row), self.is_folder(row),
+                                        self.sizes[row], self.mtimes[row])
+        return listing, remap
+
+    def __index(self, row, name):
+        key = hash(name)
+        rows = self.index.get(key)
+        if rows is None:
+            self.index[key] = row
+        elif type(rows) == int:
+            self.index[key] = (rows, row)
+        else:
+            self.index[key] = rows + (row,)
+
+
 class MTPFolder(MTPEntry, MTPRefresh):
-    files: List[MTPFile]
+    '''
+    A device folder. Children are held in a MTPListing; MTPFile/MTPFolder objects are only created (and then
+    kept in entries, keyed by row) for children that are actually looked up.
+    '''
+    __slots__ = ('must_refresh', 'listing', 'entries', 'mtp', 'writable', 'loaded', 'stale', '__weakref__')
+    listing: MTPListing
 
     def __init__(self, path, id=-2, storageid=-2, folderid=-2, mtp=None, timestamp=0, is_refresh=True):
         MTPEntry.__init__(self, id=id, path=path, folderid=folderid, storageid=storageid, timestamp=timestamp)
         MTPRefresh.__init__(self)
-        self.directories = []
-        self.files = []
+        self.listing = MTPListing()
+        self.entries = {}
         self.mtp = mtp
         self.writable = False
+        self.loaded = False  # Populated from the device or the metadata cache
+        self.stale = False  # Served from the metadata cache and not yet revalidated
+        if not mtp is None and id >= 0:
+            mtp.folders[(storageid, id)] = self
         if folderid >= -1 and is_refresh:
             self.writable = True
             self.refresh()
 
-    def refresh(self):
+    def refresh(self, from_device=False):
+        cache = self.mtp.metadata_cache
+        if not from_device and not self.loaded and not cache is None:
+            rows = cache.load_folder(self.storageid, self.id)
+            if not rows is None:
+                self.log.debug("refresh(%s, %d, %d) from metadata cache" % (self.path, self.storageid, self.folderid))
+                listing, entries = MTPListing(), {}
+                for row in rows:
+                    listing.append(*row)
+                self.listing, self.entries = listing, entries
+                self.stale = True
+                self.loaded = True
+                self.must_refresh = False
+                self.mtp.revalidate(self)
+                return True
         self.log.debug("refresh(%s, %d, %d)" % (self.path, self.storageid, self.folderid))
         readf = self.mtp.libmtp.LIBMTP_Get_Files_And_Folders
         readf.restype = POINTER(LIBMTP_file_struct)
         pfile = None
-        self.directories = []
-        self.files = []
+        # Lookups from other threads keep using the old listing until the new one is swapped in
+        old_directories = dict((entry.get_id(), entry) for entry in self.entries.values() if entry.is_directory())
+        listing, entries = MTPListing(), {}
+        rows = []
         try:
             pfile = readf(self.mtp.open_device.device, self.storageid, self.id)
             if not bool(pfile):
+                self.listing, self.entries = listing, entries
                 return False
             pf = pfile
             while bool(pf):
-                if pf[0].filetype == 0:
-                    dir = MTPFolder(path=os.path.join(self.path, pf[0].name_str), id=pf[0].item_id,
-                                    storageid=self.storageid,
-                                    folderid=pf[0].parent_id, mtp=self.mtp, timestamp=pf[0].modificationdate,
-                                    is_refresh=False)
-                    self.directories.append(dir)
-                else:
-                    self.files.append(
-                        MTPFile(pf[0].item_id, os.path.join(self.path, pf[0].name_str), self.storageid, self.folderid,
-                                pf[0].modificationdate, pf[0].filesize))
+                row = (pf[0].item_id, self.id, pf[0].name_str, pf[0].filetype == 0, pf[0].filesize,
+                       pf[0].modificationdate)
+                index = listing.append(*row)
+                if row[3]:
+                    # Keep already listed subfolders so that a relist does not discard their contents
+                    dir = old_directories.get(row[0])
+                    if not dir is None and utf8(dir.get_name()) == utf8(row[2]):
+                        entries[index] = dir
+                rows.append(row)
                 pf = pf[0].next
+            self.listing, self.entries = listing, entries
             self.must_refresh = False
+            self.stale = False
+            self.loaded = True
+            if not cache is None:
+                cache.save_folder(self.storageid, self.id, rows)
             return True
         finally:
             if not pfile is None:
                 self.mtp.libmtp.LIBMTP_destroy_file_t(pfile)
 
+    def __entry(self, row, listing=None, entries=None):
+        if listing is None:
+            listing, entries = self.listing, self.entries
+        entry = entries.get(row)
+        if entry is None:
+            path = os.path.join(self.path, listing.name(row))
+            if listing.is_folder(row):
+                entry = MTPFolder(path=path, id=listing.ids[row], storageid=self.storageid,
+                                  folderid=listing.parents[row], mtp=self.mtp, timestamp=listing.mtimes[row],
+                                  is_refresh=False)
+            else:
+                entry = MTPFile(listing.ids[row], path, self.storageid, self.id, listing.mtimes[row],
+                                listing.sizes[row])
+            entry = entries.setdefault(row, entry)
+        return entry
+
+    def __remove_row(self, row):
+        self.listing.remove(row)
+        self.entries.pop(row, None)
+        if self.listing.tombstones() > 1024 and self.listing.tombstones() > len(self.listing):
+            listing, remap = self.listing.compact()
+            entries = dict((remap[row], entry) for row, entry in self.entries.items() if row in remap)
+            self.listing, self.entries = listing, entries
+
+    def add_child(self, id, parentid, name, is_folder, size, mtime, replace=True):
+        ''' Add a child and return its row. Replaces an existing child of the same name unless replace is False '''
+        if replace:
+            row = self.listing.find(utf8(name))
+            if row >= 0:
+                self.__remove_row(row)
+        return self.listing.append(id, parentid, name, is_folder, size, mtime)
+
+    def child(self, row):
+        return self.__entry(row)
+
+    def cached_child(self, name):
+        '''
+        (known, entry) for a child using only what is already in memory, for lookups off the device executor.
+        known is False when answering would need the device (folder not listed yet) or the lookup index.
+        '''
+        listing, entries = self.listing, self.entries
+        if self.must_refresh or listing.index is None:
+            return False, None
+        row = listing.find(utf8(name))
+        if self.listing is not listing:
+            return False, None
+        return True, None if row < 0 else self.__entry(row, listing, entries)
+
+    def child_by_id(self, id):
+        row = self.listing.find_id(id)
+        return None if row < 0 else self.__entry(row)
+
     def find_directory(self, dirname):
-        dir = next((dir for dir in self.directories if utf8(dir.get_name()) == utf8(dirname)), None)
-        if not dir is None and dir.must_refresh:
+        row = self.listing.find(utf8(dirname), MTPListing.FOLDER)
+        if row < 0:
+            return None
+        dir = self.__entry(row)
+        if dir.must_refresh:
             dir.refresh()
         return dir
 
     def find_file(self, filename):
-        #      return next((f for f in self.files if utf8(f.get_name()) == utf8(filename)), None)
-        for f in self.files:
-            s1 = utf8(f.get_name())
-            s2 = utf8(filename)
-            if s1 == s2:
-                return f
-        return None
+        row = self.listing.find(utf8(filename), MTPListing.FILE)
+        return None if row < 0 else self.__entry(row)
 
     def close(self):
         pass
@@ -397,16 +714,45 @@ class MTPFolder(MTPEntry, MTPRefresh):
                 'st_size': 0, 'st_uid': os.getuid()}
 
     def get_directories(self):
-        return copy.copy(self.directories)
+        return [self.__entry(row) for row in self.listing.rows(MTPListing.FOLDER)]
 
     def get_files(self):
-        return copy.copy(self.files)
+        return [self.__entry(row) for row in self.listing.rows(MTPListing.FILE)]
+
+    def get_child_attributes(self, sort=None, reverse=False):
+        ''' (name, attributes) for every child, straight from the listing without creating entries '''
+        listing = self.listing
+        uid = os.getuid()
+        gid = os.getgid()
+        rows = listing.rows() if sort is None else listing.sorted_rows(sort, reverse)
+        for row in rows:
+            mtime = listing.mtimes[row]
+            if listing.is_folder(row):
+                mode = stat.S_IFDIR | 0o755
+                size = 0
+            else:
+                mode = stat.S_IFREG | 0o755
+                size = listing.sizes[row]
+            yield (listing.name(row), {'st_atime': mtime, 'st_ctime': mtime, 'st_gid': gid, 'st_mode': mode,
+                                       'st_mtime': mtime, 'st_nlink': 1, 'st_size': size, 'st_uid': uid})
 
     def add_file(self, file):
-        self.files.append(file)
+        row = self.add_child(file.get_id(), self.id, file.get_name(), False, file.get_length(), file.get_timestamp())
+        self.entries[row] = file
+
+    def add_directory(self, dir):
+        row = self.add_child(dir.get_id(), self.id, dir.get_name(), True, 0, dir.get_timestamp())
+        self.entries[row] = dir
+
+    def remove_child(self, name):
+        row = self.listing.find(utf8(name))
+        if row < 0:
+            return False
+        self.__remove_row(row)
+        return True
 
     def object_count(self):
-        return len(self.directories) + len(self.files)
+        return len(self.listing)
 
     def __str__(self):
         return "<MTPFolder(path:'%s' folderId:%s)>" % (self.path, self.folderid)
@@ -437,12 +783,33 @@ class MTPStorage(MTPEntry, MTPRefresh):
             storage = pstorage.contents
             self.type = storage.StorageType
             self.freespace = storage.FreeSpaceInBytes
+            self.freeobjects = storage.FreeSpaceInObjects
             self.capacity = storage.MaxCapacity
             path = os.sep + storage.StorageDescriptionStr
             MTPEntry.__init__(self, storage.id, path, storageid=None, folderid=0)
             self.root = MTPFolder(path=path, id=0, storageid=storage.id, folderid=0, mtp=self.mtp)
             self.contents[utf8(path)] = self.root
 
+    def update(self, pstorage):
+        '''
+        Point at a new LIBMTP_devicestorage_struct after the device storage list was re-read or the device was
+        reopened. Returns False if the free space or free object count changed since the last update.
+        '''
+        storage = pstorage.contents
+        unchanged = self.freespace == storage.FreeSpaceInBytes and self.freeobjects == storage.FreeSpaceInObjects
+        self.storage = pstorage
+        self.open_device = self.mtp.open_device
+        self.freespace = storage.FreeSpaceInBytes
+        self.freeobjects = storage.FreeSpaceInObjects
+        self.capacity = storage.MaxCapacity
+        return unchanged
+
+    def invalidate(self):
+        ''' Relist every cached folder of this storage on its next access, keeping the folder objects '''
+        for folder in list(self.mtp.folders.values()):
+            if folder.get_storage_id() == self.id:
+                folder.must_refresh = True
+
     def is_directory(self):
         return True
 
@@ -468,7 +835,7 @@ class MTPStorage(MTPEntry, MTPRefresh):
 
     def add_file(self, file):
         if not self.root is None:
-            self.root.add_file(self, file)
+            self.root.add_file(file)
 
     def __str__(self):
         s = "MTPStorage %s: id=%d, device=%s%s" % (self.name, self.id, self.open_device, os.linesep)
@@ -515,6 +882,22 @@ class MTPStorage(MTPEntry, MTPRefresh):
                 return self.__find_entry(en, components[1:])
             return entry.find_file(name)
 
+    def find_cached(self, path):
+        ''' (known, entry) for path walking the already listed folders only, see MTPFolder.cached_child '''
+        components = [comp for comp in utf8(path).split(os.sep) if len(comp.strip()) != 0]
+        if self.root is None or len(components) == 0 or components[0] != self.name:
+            return False, None
+        entry = self.root
+        for name in components[1:]:
+            if not entry.is_directory():
+                return True, None
+            known, entry = entry.cached_child(name)
+            if not known or entry is None:
+                return known, None
+        if entry.is_directory() and entry.must_refresh:
+            return False, None
+        return True, entry
+
     def remove_entry(self, path):
         try:
             del self.contents[utf8(path)]
@@ -522,14 +905,326 @@ class MTPStorage(MTPEntry, MTPRefresh):
         except KeyError:
             return False
 
-    def refresh(self):
+    def refresh(self, from_device=False):
         if not self.root is None and self.must_refresh:
-            self.must_refresh = not self.root.refresh()
+            self.must_refresh = not self.root.refresh(from_device)
 
     def close(self):
         pass
 
 
+class MTPDownload:
+    '''
+    Downloads a device object into a local file on the device executor so that readers on other threads can
+    consume the start of the file while the rest is still arriving. Devices that support GetPartialObject are
+    read one chunk per executor call, others with a single LIBMTP_Get_File_To_Handler call.
+    '''
+
+    def __init__(self, mtp, entry, fh):
+        self.mtp = mtp
+        self.future = None
+        self.entry = entry
+        self.fh = fh
+        self.length = entry.get_length()
+        self.received = 0
+        self.error = 0
+        self.done = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self.log = logging.getLogger("pymtpfs")
+        self.put_func = MTP.DATA_PUT_FUNC_P(self.__put)  # Keep a reference for the lifetime of the transfer
+        self.progress = MTPTransferProgress(on_stall=self.__stalled)
+        self.progress.start(None, mtp.stall_timeout('download'))
+        self.reconnects = 0
+
+    def __put(self, params, priv, sendlen, data, putlen):
+        if self.cancelled or self.progress.timed_out:
+            return LIBMTP_HANDLER_RETURN_CANCEL
+        try:
+            buf = string_at(data, sendlen)
+            written = 0
+            while written < sendlen:
+                written += os.pwrite(self.fh, buf[written:], self.received + written)
+        except OSError:
+            self.log.exception("Error writing download of %s" % (self.entry.get_path(),))
+            return LIBMTP_HANDLER_RETURN_ERROR
+        putlen[0] = sendlen
+        with self.condition:
+            self.received += sendlen
+            self.condition.notify_all()
+        return LIBMTP_HANDLER_RETURN_OK
+
+    def start(self):
+        if self.length > TRANSFER_CHUNK_SIZE and self.mtp.supports_partial_reads():
+            self.__submit_chunk()
+        else:
+            self.future = self.mtp.executor.submit(self.__transfer, priority=FOREGROUND)
+
+    def __submit_chunk(self):
+        self.future = self.mtp.executor.submit(self.__chunk, priority=FOREGROUND)
+        self.future.add_done_callback(self.__chunk_done)
+
+    def __chunk(self):
+        if self.cancelled:
+            return False
+        data = self.mtp.get_partial_object(self.entry.get_id(), self.received,
+                                           min(TRANSFER_CHUNK_SIZE, self.length - self.received))
+        if (data is None or len(data) == 0) and self.reconnects < 2 and self.mtp.reconnect():
+            # Resume at the first missing byte on the reopened device
+            self.reconnects += 1
+            self.log.info("Resuming download of %s at byte %d" % (self.entry.get_path(), self.received))
+            self.progress.start(None)
+            return True
+        if data is None or len(data) == 0:
+            return False
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.fh, data[written:], self.received + written)
+        with self.condition:
+            self.received += len(data)
+            self.condition.notify_all()
+        if not self.progress.update(self.received, self.length):
+            self.log.error("Download of %s stalled" % (self.entry.get_path(),))
+            return False
+        return True
+
+    def __chunk_done(self, future):
+        ok = False
+        try:
+            ok = future.result()
+        except CancelledError:
+            pass
+        except Exception:
+            self.log.exception("Download of %s failed" % (self.entry.get_path(),))
+        if ok and not self.cancelled and self.received < self.length:
+            try:
+                self.__submit_chunk()
+                return
+            except RuntimeError:
+                pass
+        with self.condition:
+            if self.received < self.length:
+                self.error = errno.EINTR if self.cancelled else errno.EIO
+            self.done = True
+            self.condition.notify_all()
+        self.mtp.record_transfer('download', self.entry.get_path(), self.progress, self.error == 0)
+
+    def __transfer(self):
+        err = errno.EIO
+        try:
+            if not self.mtp.open_device is None and not self.cancelled:
+                self.mtp.libmtp.LIBMTP_Clear_Errorstack(self.mtp.open_device.device)
+                ret = self.mtp.libmtp.LIBMTP_Get_File_To_Handler(self.mtp.open_device.device,
+                                                                 self.entry.get_id(), self.put_func, None,
+                                                                 self.progress.callback, None)
+                if ret == 0:
+                    err = 0
+                elif self.cancelled:
+                    err = errno.EINTR
+                else:
+                    self.mtp.libmtp.LIBMTP_Dump_Errorstack(self.mtp.open_device.device)
+        except:
+            self.log.exception("Download of %s failed" % (self.entry.get_path(),))
+        finally:
+            with self.condition:
+                self.error = err
+                self.done = True
+                self.condition.notify_all()
+            self.mtp.record_transfer('download', self.entry.get_path(), self.progress, err == 0)
+
+    def __stalled(self):
+        # The transfer may be stuck in a USB call that only libusb's timeout ends, readers fail now instead
+        with self.condition:
+            if not self.done:
+                self.error = errno.ETIMEDOUT
+                self.done = True
+                self.condition.notify_all()
+
+    def wait_for(self, end):
+        ''' Wait until the first end bytes have arrived. Returns 0 or an errno if the transfer failed first '''
+        end = min(end, self.length)
+        with self.condition:
+            while self.received < end and not self.done:
+                self.condition.wait()
+            if self.received >= end:
+                return 0
+            return self.error if self.error != 0 else errno.EIO
+
+    def cancel(self):
+        self.cancelled = True
+        if not self.future is None and not self.future.cancel():
+            try:
+                self.future.result()
+            except Exception:
+                pass
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+
+class MTPRingBuffer:
+    ''' Bounded byte FIFO between one writer and one reader thread. write() blocks while the buffer is full '''
+
+    def __init__(self, size=STREAM_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.count = 0
+        self.closed = False  # No more writes, read() returns b'' once drained
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        ''' Append all of data. False if the buffer was aborted '''
+        data = memoryview(data)
+        size = len(self.buffer)
+        while len(data) > 0:
+            with self.condition:
+                while self.count == size and not self.aborted:
+                    self.condition.wait()
+                if self.aborted:
+                    return False
+                end = (self.start + self.count) % size
+                n = min(len(data), size - self.count, size - end)
+                self.buffer[end:end + n] = data[:n]
+                self.count += n
+                self.condition.notify_all()
+            data = data[n:]
+        return True
+
+    def read(self, size, timeout=None):
+        ''' Up to size bytes, b'' once closed and drained, None if aborted or nothing arrived within timeout '''
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.count == 0 and not self.closed and not self.aborted:
+                remaining = None if deadline is None else deadline - time.time()
+                if not remaining is None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            if self.aborted:
+                return None
+            if self.count == 0:
+                return b''
+            n = min(size, self.count, len(self.buffer) - self.start)
+            data = bytes(self.buffer[self.start:self.start + n])
+            self.start = (self.start + n) % len(self.buffer)
+            self.count -= n
+            self.condition.notify_all()
+            return data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+
+class MTPUploadStream:
+    '''
+    Uploads a new file while it is still being written, for writers that write strictly sequentially. Needs a
+    device that supports editing: an empty object is created and the data, passed through a bounded
+    MTPRingBuffer, is appended with SendPartialObject, one chunk per executor call, so waiting for the writer
+    happens off the executor and nothing is kept locally. size, if known, is the length the file was truncated
+    to: writes past it are refused and a shorter file is padded with zeros. timestamp is a modification time
+    asked for while the file was streamed, for the caller to set once the stream has finished.
+    '''
+
+    def __init__(self, mtp, path, size=None):
+        self.mtp = mtp
+        self.path = path
+        self.size = size
+        self.timestamp = None
+        self.buffer = MTPRingBuffer()
+        self.offset = 0  # Bytes accepted by write()
+        self.error = 0
+        self.entry = None  # The device file, once created
+        self.cancelled = False
+        self.log = logging.getLogger("pymtpfs")
+        self.get_func = MTP.DATA_GET_FUNC_P(self.__get)  # Keep a reference for the lifetime of the transfer
+        self.progress = MTPTransferProgress()
+        self.thread = threading.Thread(target=self.__run, name="pymtpfs-upload-stream")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def write(self, offset, data):
+        ''' Queue data for the device. False, with nothing queued, if data does not continue the stream '''
+        if offset != self.offset or self.error != 0 or self.cancelled or \
+                (not self.size is None and offset + len(data) > self.size):
+            return False
+        if not self.buffer.write(data):
+            return False
+        self.offset += len(data)
+        return True
+
+    def finish(self):
+        ''' Wait until everything written is on the device. Returns 0 or an errno value '''
+        while not self.size is None and self.offset < self.size and self.error == 0 and not self.cancelled:
+            # The rest of a file that was made longer than what was written reads as zeros
+            padding = bytes(min(TRANSFER_CHUNK_SIZE, self.size - self.offset))
+            if not self.buffer.write(padding):
+                break
+            self.offset += len(padding)
+        self.buffer.close()
+        self.thread.join()
+        return self.error
+
+    def cancel(self):
+        ''' Stop sending and remove what the device received '''
+        self.cancelled = True
+        self.progress.cancel()
+        self.buffer.abort()
+        self.thread.join()
+
+    def __run(self):
+        try:
+            self.error = self.__append()
+        except Exception:
+            self.log.exception("Streaming upload of %s failed" % (self.path,))
+            self.error = errno.EIO
+        if self.cancelled and not self.entry is None:
+            self.mtp.rm(self.path)
+            self.entry = None
+        self.mtp.record_transfer('upload', self.path, self.progress, self.error == 0 and not self.cancelled)
+
+    def __get(self, params, priv, wantlen, data, gotlen):
+        # Only the empty object is sent this way, the data follows with SendPartialObject
+        gotlen[0] = 0
+        return LIBMTP_HANDLER_RETURN_OK if wantlen == 0 else LIBMTP_HANDLER_RETURN_ERROR
+
+    def __append(self):
+        err, self.entry = self.mtp.send_from_handler(self.path, 0, self.get_func, self.progress)
+        if err != 0:
+            return err
+        err = self.mtp.begin_edit(self.entry)
+        if err != 0:
+            return err
+        sent = 0
+        try:
+            while err == 0:
+                chunk = self.buffer.read(TRANSFER_CHUNK_SIZE, self.progress.stall_timeout)
+                if chunk is None:
+                    err = errno.ECANCELED if self.cancelled else errno.ETIMEDOUT
+                elif len(chunk) == 0:
+                    break
+                else:
+                    # Collect up to a full chunk from what is already buffered so that there are fewer calls
+                    while len(chunk) < TRANSFER_CHUNK_SIZE and self.buffer.count > 0:
+                        chunk += self.buffer.read(TRANSFER_CHUNK_SIZE - len(chunk), 0) or b''
+                    err = self.mtp.send_partial_object(self.entry, sent, chunk)
+                    sent += len(chunk)
+                    self.progress.update(sent, max(sent, self.offset))
+        finally:
+            err = self.mtp.end_edit(self.entry, sent, err)
+        if err == 0:
+            self.entry = self.mtp.get_path(self.path)
+        return err
+
+
 class MTP:
     global MTP_PATH
     MTP_PATH = find_library('mtp')
@@ -537,9 +1232,11 @@ class MTP:
         raise EnvironmentError('Unable to find libmtp')
     CDLL(MTP_PATH).LIBMTP_Init()
 
-    PROGRESS_FUNC_P = CFUNCTYPE(c_uint64, c_uint64, c_void_p)
+    PROGRESS_FUNC_P = PROGRESS_FUNC_P
+    DATA_PUT_FUNC_P = CFUNCTYPE(c_uint16, c_void_p, c_void_p, c_uint32, POINTER(c_ubyte), POINTER(c_uint32))
+    DATA_GET_FUNC_P = CFUNCTYPE(c_uint16, c_void_p, c_void_p, c_uint32, POINTER(c_ubyte), POINTER(c_uint32))
 
-    def __init__(self, is_debug=False):
+    def __init__(self, is_debug=False, metadata_cache_path=None, events=False, upload_journal_path=None):
         global MTP_PATH
         self.libmtp = CDLL(MTP_PATH)
         self.libc = CDLL(find_library('c'))
@@ -551,6 +1248,22 @@ class MTP:
         self.open_device: Optional[MTPDevice] = None
         self.last_error = 0
         self.last_error_message = "OK"
+        self.executor = MTPExecutor()
+        self.executor.start()
+        self.block_cache = MTPBlockCache()
+        self.capabilities = {}  # LIBMTP_DEVICECAP_* or (LIBMTP_PROPERTY_*, filetype) -> bool, per open device
+        self.device_extensions = None  # extensions() of the open device once read
+        self.metadata_cache_path = metadata_cache_path
+        self.metadata_cache: Optional[MTPMetadataCache] = None
+        self.revalidator: Optional[MTPRevalidator] = None
+        self.folders = weakref.WeakValueDictionary()  # (storage id, folder id) -> MTPFolder
+        self.events = events
+        self.event_listener: Optional[MTPEventListener] = None
+        self.device_key = None  # vendor:product:serial of the open device
+        self.retained = {}  # storage id -> MTPStorage kept by close(keep_cache=True) for retained_key
+        self.retained_key = None
+        self.upload_journal = MTPUploadJournal(upload_journal_path)
+        self.throughput = {}  # device key -> MTPThroughputStats, kept across reconnects
         self.refresh()
         self.is_debug = is_debug
         self.log = logging.getLogger("pymtpfs")
@@ -586,6 +1299,7 @@ class MTP:
     def count(self):
         return len(self.devices)
 
+    @scheduled(METADATA)
     def open(self, devno, must_refresh=False) -> bool:
         if self.devices is None or len(self.devices) == 0 or must_refresh:
             self.refresh()
@@ -629,27 +1343,154 @@ class MTP:
                 self.open_device.set_mtp_device(device)
                 self.open_device.vendor_id = vendorid
                 self.open_device.product_id = productid
+                self.device_key = "%04x:%04x:%s" % (vendorid, productid, self.__serial_number(device))
+                if not self.metadata_cache_path is None:
+                    self.__open_metadata_cache()
+                retained = self.retained if self.retained_key == self.device_key else {}
+                self.retained = {}
                 pstorage = device.contents.storage
+                kept = set()  # Ids of the retained storages that did not change
                 while bool(pstorage):
-                    newstorage = MTPStorage(self, pstorage)
-                    self.storages[pstorage[0].StorageDescriptionStr] = newstorage
+                    description = pstorage[0].StorageDescriptionStr
+                    newstorage = retained.get(pstorage[0].id)
+                    if newstorage is None or newstorage.get_name() != description:
+                        newstorage = MTPStorage(self, pstorage)
+                    elif newstorage.update(pstorage):
+                        self.log.info("Reopened %s: storage %s unchanged, keeping its cache" %
+                                      (self.device_key, description))
+                        kept.add(newstorage.get_id())
+                    else:
+                        self.log.info("Reopened %s: storage %s changed, relisting cached folders on access" %
+                                      (self.device_key, description))
+                        newstorage.invalidate()
+                    self.storages[description] = newstorage
                     pstorage = pstorage[0].next
+                if len(kept) != len(retained) or len(retained) == 0:
+                    # Blocks are keyed by object id alone, objects of a changed storage may hold other data now
+                    self.block_cache.clear()
                 rootstorage = MTPStorage(self, None)
                 self.storages[os.sep] = rootstorage
+                self.__check_interrupted_uploads()
+                if self.events:
+                    self.event_listener = MTPEventListener(self)
+                    self.event_listener.start()
                 return True
         return False
 
-    def close(self):
+    @scheduled(METADATA)
+    def close(self, keep_cache=False):
+        '''
+        Release the device. With keep_cache the storages and their cached folders are kept so that reopening
+        the same device (after a transfer error) only has to revalidate them instead of relisting everything.
+        '''
         #      for storage in self.storages.values():
         #         storage.close()
+        if not self.event_listener is None:
+            self.event_listener.stop()
+            self.event_listener = None
+        if keep_cache and not self.device_key is None:
+            self.retained = dict((storage.get_id(), storage) for name, storage in self.storages.items()
+                                 if name != os.sep)
+            self.retained_key = self.device_key
+        else:
+            self.retained = {}
+            self.folders.clear()
         self.storages.clear()
         self.devices = None
+        self.capabilities.clear()
+        self.device_extensions = None
+        if not self.revalidator is None:
+            self.revalidator.stop()
+            self.revalidator = None
+        if not self.metadata_cache is None:
+            self.metadata_cache.close()
+            self.metadata_cache = None
         if not self.open_device is None and not self.open_device.device is None and not self.open_device.device.contents is None:
             self.log.info('Releasing device')
             self.libmtp.LIBMTP_Release_Device(self.open_device.device)
         self.open_device = None
         return True
 
+    def __serial_number(self, device):
+        get_serial = self.libmtp.LIBMTP_Get_Serialnumber
+        get_serial.restype = c_void_p
+        serial = ''
+        pserial = get_serial(device)
+        if pserial:
+            serial = string_at(pserial).decode('utf-8', 'ignore')
+            self.libc.free(c_void_p(pserial))
+        return serial
+
+    def __open_metadata_cache(self):
+        try:
+            self.metadata_cache = MTPMetadataCache(self.metadata_cache_path, self.device_key)
+        except Exception:
+            self.log.exception("Could not open metadata cache %s" % (self.metadata_cache_path,))
+            self.metadata_cache = None
+            return
+        self.revalidator = MTPRevalidator(self)
+        self.revalidator.start()
+
+    def object_added(self, objectid):
+        ''' Add an object created on the device to its parent folder, if that folder is already cached '''
+        getmetadata = self.libmtp.LIBMTP_Get_Filemetadata
+        getmetadata.restype = POINTER(LIBMTP_file_struct)
+        pfile = getmetadata(self.open_device.device, c_uint32(objectid))
+        if not bool(pfile):
+            return False
+        try:
+            parentid = 0 if pfile[0].parent_id == 0xFFFFFFFF else pfile[0].parent_id
+            folder = self.folders.get((pfile[0].storage_id, parentid))
+            if folder is None or not folder.loaded:
+                return False  # Listed when first needed
+            folder.add_child(objectid, parentid, pfile[0].name_str, pfile[0].filetype == 0, pfile[0].filesize,
+                             pfile[0].modificationdate)
+            return True
+        finally:
+            self.libmtp.LIBMTP_destroy_file_t(pfile)
+
+    def object_removed(self, objectid):
+        ''' Drop an object deleted on the device from the cached folder that holds it '''
+        self.block_cache.invalidate(objectid)
+        for folder in list(self.folders.values()):
+            entry = folder.child_by_id(objectid)
+            if not entry is None:
+                folder.remove_child(entry.get_name())
+                self.folders.pop((entry.get_storage_id(), objectid), None)
+                storage = self.get_storage(entry.get_path())
+                if not storage is None:
+                    storage.remove_entry(entry.get_path())
+                return True
+        return False
+
+    def refresh_storages(self):
+        ''' Re-read the storage list after a storage was added to or removed from the device '''
+        err = self.libmtp.LIBMTP_Get_Storage(self.open_device.device, 0)
+        if err != 0:
+            self.last_error = err
+            return False
+        seen = set()
+        pstorage = self.open_device.device.contents.storage
+        while bool(pstorage):
+            description = pstorage[0].StorageDescriptionStr
+            seen.add(description)
+            storage = self.storages.get(description)
+            if storage is None or storage.get_id() != pstorage[0].id:
+                self.storages[description] = MTPStorage(self, pstorage)
+            else:
+                storage.update(pstorage)
+            pstorage = pstorage[0].next
+        for description in [d for d in self.storages.keys() if d != os.sep and not d in seen]:
+            del self.storages[description]
+        self.storages.pop(os.sep, None)
+        self.storages[os.sep] = MTPStorage(self, None)
+        return True
+
+    def revalidate(self, folder):
+        ''' Queue a folder that was served from the metadata cache for a background relist '''
+        if not self.revalidator is None:
+            self.revalidator.submit(folder)
+
     def get_storage(self, path: Optional[str] = None) -> Optional[MTPStorage]:
         if self.open_device is None:
             return None
@@ -665,68 +1506,333 @@ class MTP:
             return None
         return [s for s in self.storages.keys()]
 
-    def copy_from(self, source, target, timeout=None, recurse=0):
-        timeouterr = [0, ]
-
-        def timeout_handler(sig, frame):
-            timeouterr[0] = errno.EINTR
-
+    def copy_from(self, source, target, timeout=None, recurse=0, progress=None, priority=FOREGROUND):
+        '''
+        Download source into a local path or file handle. progress is an optional MTPTransferProgress that
+        receives updates and can cancel the transfer, in which case errno.ECANCELED is returned. priority is
+        the device executor class the transfer runs in.
+        '''
         entry = self.get_path(source)
         if entry is None:
             return errno.ENOENT
         if entry.is_directory():
             return errno.EISDIR
-        oldhandler = None
-        if not timeout is None:
-            oldhandler = signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(timeout)
+        if progress is None:
+            progress = MTPTransferProgress()
+        progress.start(timeout, self.stall_timeout('download'))
+        if type(target) == int and entry.get_length() > TRANSFER_CHUNK_SIZE and self.supports_partial_reads():
+            err = self.__copy_chunks(entry, target, timeout, progress, priority=priority)
+        else:
+            err = self.executor.call(self.__copy_from, source, entry, target, timeout, recurse, progress,
+                                     priority=priority)
+        if recurse == 0:
+            self.record_transfer('download', entry.get_path(), progress, err == 0)
+        return err
+
+    def __copy_chunks(self, entry, fh, timeout, progress, offset=0, base=0, priority=FOREGROUND):
+        '''
+        Download entry from offset into fh at base + offset, one chunk per executor call so that metadata
+        requests can run in between. The next chunk is requested before the current one is written so the
+        host write overlaps the USB transfer. If a chunk fails because the device went away, the device is
+        reopened and the download resumes at the first missing byte.
+        '''
+        length = entry.get_length()
+        reconnects = 0
+        pending = None
         try:
-            self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
-            if type(target) == str or type(target) == unicode:
-                ret = self.libmtp.LIBMTP_Get_File_To_File(self.open_device.device, entry.get_id(), c_char_p(target),
-                                                          None, None)
-            else:
-                ret = self.libmtp.LIBMTP_Get_File_To_File_Descriptor(self.open_device.device, entry.get_id(), target,
-                                                                     None, None)
-            #                                                                 MTP.PROGRESS_FUNC_P(), c_void_p())
-            signal.alarm(0)
+            while offset < length:
+                if not progress.update(offset, length):
+                    if progress.cancelled:
+                        return errno.ECANCELED
+                    if progress.stalled_out:
+                        self.log.error("Transfer of %s stalled for %.0f seconds" % (entry.get_path(),
+                                                                                    progress.stall_timeout))
+                    else:
+                        self.log.error("Timeout transferring %s in %d seconds" % (entry.get_path(), timeout))
+                    return errno.EINTR
+                if pending is None:
+                    pending = self.__fetch_chunk(entry, offset, priority)
+                data = pending.result()
+                pending = None
+                if data is None or len(data) == 0:
+                    if reconnects < 2 and self.reconnect():
+                        reconnects += 1
+                        self.log.info("Resuming download of %s at byte %d" % (entry.get_path(), offset))
+                        progress.start(None)
+                        continue
+                    return errno.EIO
+                if offset + len(data) < length:
+                    pending = self.__fetch_chunk(entry, offset + len(data), priority)
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(fh, data[written:], base + offset + written)
+                offset += len(data)
         finally:
-            if not oldhandler is None:
-                signal.signal(signal.SIGALRM, oldhandler)
+            if not pending is None and not pending.cancel():
+                pending.exception()
+        progress.update(length, length)
+        return 0
+
+    def __fetch_chunk(self, entry, offset, priority):
+        ''' Future for the chunk of entry at offset. Runs inline (and is done) when called on the executor '''
+        length = min(TRANSFER_CHUNK_SIZE, entry.get_length() - offset)
+        if self.executor.is_executor_thread():
+            future = Future()
+            future.set_result(self.get_partial_object(entry.get_id(), offset, length))
+            return future
+        return self.executor.submit(self.get_partial_object, entry.get_id(), offset, length, priority=priority)
+
+    @scheduled(FOREGROUND)
+    def reconnect(self):
+        ''' Reopen the device after a transfer error if it no longer responds, keeping the caches '''
+        if self.check():
+            return False
+        devno = "%04x:%04x" % (self.open_device.vendor_id, self.open_device.product_id)
+        self.close(keep_cache=True)
+        return self.open(devno, must_refresh=True)
+
+    def __copy_from(self, source, entry, target, timeout, recurse, progress):
+        # The transfer runs on the device executor thread so a SIGALRM based timeout is not possible,
+        # the progress callback cancels the transfer instead.
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        start = None
+        if type(target) == str or type(target) == unicode:
+            ret = self.libmtp.LIBMTP_Get_File_To_File(self.open_device.device, entry.get_id(),
+                                                      c_char_p(bytes(target, "utf8")), progress.callback, None)
+        else:
+            start = os.lseek(target, 0, os.SEEK_CUR)
+            ret = self.libmtp.LIBMTP_Get_File_To_File_Descriptor(self.open_device.device, entry.get_id(), target,
+                                                                 progress.callback, None)
         if ret != 0:
             try:
                 sys.stderr.write(str(source) + ' ->  ' + str(target) + os.linesep)
             except:
                 pass
             self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
-        if timeouterr[0] != 0:
-            if timeouterr[0] != 0:
+        if progress.cancelled:
+            return errno.ECANCELED
+        # Reconnect and resume after a timeout or when the error came from the device going away (USB error,
+        # device reset); a device that still responds rejected the transfer itself
+        if progress.timed_out or (ret != 0 and not self.check()):
+            if progress.stalled_out:
+                self.log.error("Transfer of %s to %s stalled for %.0f seconds" % (str(source), str(target),
+                                                                                  progress.stall_timeout))
+            elif progress.timed_out:
                 self.log.error("Timeout transferring %s to %s in %d seconds" % (str(source), str(target), timeout))
             else:
-                self.log.error("Error transferring %s to %s" % (str(source), str(target)))
+                self.log.error("Error transferring %s to %s, the device is not responding" %
+                               (str(source), str(target)))
             devno = "%04x:%04x" % (self.open_device.vendor_id, self.open_device.product_id)
+            # The file descriptor position is past the last byte written, resume from there if possible
+            received = 0 if start is None else os.lseek(target, 0, os.SEEK_CUR) - start
             if recurse == 0:
                 #            self.log.warn('Resetting device ' +  devno)
                 #            ret = self.libmtp.LIBMTP_Reset_Device(self.open_device.device)
-                self.close()
+                self.close(keep_cache=True)
                 if self.open(devno, must_refresh=False):
-                    return self.copy_from(source, target, timeout, recurse=1)
+                    if received > 0 and self.supports_partial_reads():
+                        self.log.info("Resuming download of %s at byte %d" % (str(source), received))
+                        progress.start(timeout)
+                        return self.__copy_chunks(entry, target, timeout, progress, received, start)
+                    return self.copy_from(source, target, timeout, recurse=1, progress=progress)
                 else:
                     recurse = 1
             if recurse == 1:
                 self.log.error('Reset device failed. Attempting to reopen')
-                self.close()
+                self.close(keep_cache=True)
                 if not self.open(devno, must_refresh=True):
                     self.log.error("Could not reopen device.")
                     return errno.EINTR
-                return self.copy_from(source, target, timeout, recurse=2)
+                return self.copy_from(source, target, timeout, recurse=2, progress=progress)
             if recurse == 2:
                 return errno.EINTR
         if ret != 0:
             return errno.EIO
         return 0
 
+    def record_transfer(self, direction, path, progress, ok):
+        ''' Add a finished transfer to the rolling statistics of the open device '''
+        record = progress.record(direction, path, ok)
+        if self.device_key is None:
+            return
+        stats = self.throughput.get(self.device_key)
+        if stats is None:
+            stats = self.throughput.setdefault(self.device_key, MTPThroughputStats(self.device_key))
+        stats.add(record)
+        self.log.debug(str(record))
+
+    def stall_timeout(self, direction):
+        ''' Seconds without progress after which a transfer is aborted, adapted to the measured device rate '''
+        stats = self.throughput_stats()
+        rate = 0.0 if stats is None else stats.rate(direction)
+        if rate <= 0:
+            return STALL_TIMEOUT_DEFAULT
+        return min(STALL_TIMEOUT_MAX, max(STALL_TIMEOUT_MIN, STALL_TIMEOUT_FACTOR * TRANSFER_CHUNK_SIZE / rate))
+
+    def throughput_stats(self):
+        ''' MTPThroughputStats of the open device, None if no transfer was made '''
+        return None if self.device_key is None else self.throughput.get(self.device_key)
+
+    def scheduler_stats(self):
+        ''' Queue depth, call counts and wait times of each device executor priority class '''
+        return self.executor.stats()
+
+    def copy_tree(self, source, target, priority=BACKGROUND, fsync=True):
+        ''' Copy the device folder source into the host directory target. Returns a tree.MTPManifest '''
+        return download_tree(self, source, target, priority, fsync)
+
+    def upload_tree(self, source, target, priority=BACKGROUND):
+        ''' Copy the host directory source into the device folder target. Returns a tree.MTPManifest '''
+        return upload_tree(self, source, target, priority)
+
+    def sync(self, device_path, local_path, direction=DOWNLOAD, deletion=DELETE_KEEP, dry_run=False,
+             priority=BACKGROUND):
+        '''
+        Copy only the new and changed files from device_path to local_path (or the other way round) and
+        apply the deletion policy. Returns a sync.MTPSyncReport, with only the plan filled in for a dry run.
+        '''
+        return MTPSync(self, device_path, local_path, direction, deletion, priority=priority).run(dry_run)
+
+    def download(self, source, fh):
+        ''' Start a background download of source into the open local file fh and return the MTPDownload '''
+        entry = source
+        if type(source) == str or type(source) == unicode:
+            entry = self.get_path(source)
+        if entry is None or entry.is_directory():
+            return None
+        download = MTPDownload(self, entry, fh)
+        download.start()
+        return download
+
+    def supports(self, capability):
+        '''
+        True if the open device has a LIBMTP_DEVICECAP_* capability. Asked once per device on the executor,
+        later lookups are answered on the calling thread so they do not wait for a running transfer.
+        '''
+        supported = self.capabilities.get(capability)
+        if supported is None:
+            supported = self.executor.call(self.__check_capability, capability, priority=METADATA)
+        return supported
+
+    def __check_capability(self, capability):
+        if self.open_device is None:
+            return False
+        if not capability in self.capabilities:
+            self.capabilities[capability] = bool(self.libmtp.LIBMTP_Check_Capability(self.open_device.device,
+                                                                                     capability))
+        return self.capabilities[capability]
+
+    def supports_partial_reads(self):
+        return self.supports(LIBMTP_DEVICECAP_GetPartialObject)
+
+    def extensions(self):
+        ''' (name, major, minor) of the vendor extensions the open device advertises, read once per device '''
+        extensions = self.device_extensions
+        if extensions is None:
+            extensions = self.executor.call(self.__read_extensions, priority=METADATA)
+        return extensions
+
+    def __read_extensions(self):
+        if self.open_device is None:
+            return []
+        if self.device_extensions is None:
+            extensions = []
+            pext = self.open_device.device.contents.extensions
+            while bool(pext):
+                extensions.append((pext[0].name.decode('utf-8', 'replace'), pext[0].major, pext[0].minor))
+                pext = pext[0].next
+            self.device_extensions = extensions
+        return self.device_extensions
+
+    def supports_editing(self):
+        ''' True if objects can be changed in place (the Android BeginEditObject/EndEditObject extension) '''
+        return self.supports(LIBMTP_DEVICECAP_EditObjects) and \
+               any(name == 'android.com' for name, _, _ in self.extensions())
+
+    def read(self, source, offset, size):
+        '''
+        Read size bytes at offset from a device object without downloading all of it. Blocks are fetched
+        with GetPartialObject and kept in the block cache. Cached blocks are served on the calling thread, only
+        the missing ones are fetched on the device executor. Returns None on error.
+        '''
+        entry = source
+        if type(source) == str or type(source) == unicode:
+            entry = self.get_path(source)
+        if entry is None or entry.is_directory():
+            return None
+        length = entry.get_length()
+        if offset >= length or size <= 0:
+            return b''
+        end = min(offset + size, length)
+        blocksize = self.block_cache.blocksize
+        blocks = {}
+        missing = []
+        for blockno in range(offset // blocksize, (end - 1) // blocksize + 1):
+            block = self.block_cache.get(entry.get_id(), blockno)
+            if block is None:
+                missing.append(blockno)
+            else:
+                blocks[blockno] = block
+        if len(missing) > 0:
+            fetched = self.executor.call(self.__fetch_blocks, entry, missing, priority=FOREGROUND)
+            if fetched is None:
+                return None
+            blocks.update(fetched)
+        first = (offset // blocksize) * blocksize
+        return b''.join(blocks[blockno] for blockno in sorted(blocks))[offset - first:end - first]
+
+    def __fetch_blocks(self, entry, blocknos):
+        ''' Block number -> data for blocknos of entry, fetched into the block cache on the executor '''
+        length = entry.get_length()
+        blocksize = self.block_cache.blocksize
+        blocks = {}
+        for blockno in blocknos:
+            # Another reader may have fetched the block while this call waited for the executor
+            block = self.block_cache.get(entry.get_id(), blockno)
+            if block is None:
+                start = blockno * blocksize
+                block = self.get_partial_object(entry.get_id(), start, min(blocksize, length - start))
+                if block is None:
+                    return None
+                self.block_cache.put(entry.get_id(), blockno, block)
+            blocks[blockno] = block
+        return blocks
+
+    def get_partial_object(self, objectid, offset, length):
+        ''' GetPartialObject, must be called on the device executor. Returns the bytes read or None on error '''
+        if self.open_device is None:
+            return None
+        pdata = POINTER(c_ubyte)()
+        size = c_uint(0)
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        err = self.libmtp.LIBMTP_GetPartialObject(self.open_device.device, c_uint32(objectid), c_uint64(offset),
+                                                  c_uint32(length), byref(pdata), byref(size))
+        try:
+            if err != 0:
+                self.log.error("GetPartialObject %d (%d bytes at %d) failed" % (objectid, length, offset))
+                self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+                return None
+            return string_at(pdata, size.value)
+        finally:
+            if bool(pdata):
+                self.libc.free(pdata)
+
+    def find_cached(self, path):
+        ''' (known, entry) for path from the already listed folders, without any device I/O '''
+        storage = self.get_storage(path)
+        if storage is None:
+            return False, None
+        return storage.find_cached(path)
+
     def get_path(self, path):
+        ''' Answered from the listed folders on the calling thread when possible, otherwise on the executor '''
+        if not self.executor.is_executor_thread():
+            known, en = self.find_cached(path)
+            if known:
+                return en
+        return self.executor.call(self.__get_path, path, priority=METADATA)
+
+    def __get_path(self, path):
         storage = self.get_storage(path)
         if storage is None:
             raise ValueError("Could not find a MTP storage for path " + path)
@@ -735,6 +1841,7 @@ class MTP:
             en.refresh()
         return en
 
+    @scheduled(METADATA)
     def remove_path(self, path):
         storage = self.get_storage(path)
         if storage is None:
@@ -743,6 +1850,7 @@ class MTP:
         return storage.remove_entry(path)
 
     # Create a dummy zero length file in the cache
+    @scheduled(METADATA)
     def create(self, path):
         dirpath, name = os.path.split(path)
         folderid = storageid = -1
@@ -761,12 +1869,81 @@ class MTP:
             direntry.add_file(newfile)
         return newfile
 
-    def copy_to(self, source: str, target: str, timeout=None, timestamp=None, recurse=0, retry=0):
-        timeouterr = [0, ]
-
-        def timeout_handler(sig, frame):
-            timeouterr[0] = errno.EINTR
+    @scheduled(BACKGROUND)
+    def copy_to(self, source: str, target: str, timeout=None, timestamp=None, recurse=0, retry=0, progress=None):
+        if progress is None:
+            progress = MTPTransferProgress()
+        if recurse == 0:
+            try:
+                size = os.fstat(source).st_size if type(source) == int else os.path.getsize(source)
+                self.upload_journal.begin(self.device_key, target, size, None if type(source) == int else source)
+            except OSError:
+                pass
+        err = self.__copy_to(source, target, timeout, timestamp, recurse, progress)
+        if recurse == 0:
+            self.record_transfer('upload', target, progress, err == 0)
+            if err == 0:
+                self.upload_journal.finish(self.device_key, target)
+        return err
+
+    def __upload_completed(self, target, source=None):
+        '''
+        True if the journal records an upload of target and the device verifiably has the complete object. The
+        size of an object is the one announced before its data was sent, so a matching size is not enough: the
+        end of the object, which a cut off transfer lacks, must match the local source (source or the journaled
+        source path). The device copy is left alone either way, a retried copy_to replaces it when it sends the
+        file again.
+        '''
+        record = self.upload_journal.get(self.device_key, target)
+        if record is None:
+            return False
+        entry = self.get_path(target)
+        if entry is None or entry.is_directory():
+            return False
+        if source is None:
+            source = record['source']
+        if entry.get_length() == record['size'] and self.__verify_upload(entry, source):
+            self.log.info("Upload of %s completed before the device was reset" % (target,))
+            self.upload_journal.finish(self.device_key, target)
+            return True
+        return False
 
+    def __verify_upload(self, entry, source):
+        ''' Compare the last block of entry with the same bytes of source (a local path or file handle) '''
+        if source is None or not self.supports_partial_reads():
+            return False
+        length = entry.get_length()
+        size = min(length, PARTIAL_BLOCK_SIZE)
+        if size == 0:
+            return True
+        try:
+            if type(source) == int:
+                expected = os.pread(source, size, length - size)
+            else:
+                with open(source, 'rb') as f:
+                    f.seek(length - size)
+                    expected = f.read(size)
+        except OSError:
+            return False
+        data = self.executor.call(self.get_partial_object, entry.get_id(), length - size, size, priority=METADATA)
+        return not data is None and data == expected
+
+    def __check_interrupted_uploads(self):
+        '''
+        Clear journaled uploads the device received in full, report the ones that were interrupted or could not
+        be verified (without GetPartialObject). Nothing is removed from the device.
+        '''
+        for record in self.upload_journal.pending(self.device_key):
+            if self.__upload_completed(record['target']):
+                continue
+            entry = self.get_path(record['target'])
+            self.log.warning("Upload of %s (%d bytes%s) was interrupted, %s" %
+                             (record['target'], record['size'],
+                              '' if record['source'] is None else ' from ' + record['source'],
+                              'the device has no copy' if entry is None else
+                              'the device copy (%d bytes) may be incomplete' % (entry.get_length(),)))
+
+    def __copy_to(self, source, target, timeout, timestamp, recurse, progress):
         direntry, entry, dirpath, name = self.__entry_and_dir(target)
         if entry is None:
             if not direntry is None and not direntry.is_directory():
@@ -775,13 +1952,11 @@ class MTP:
             if entry.is_directory():
                 return errno.EISDIR
             if entry.get_id() >= 0:
-                err = self.libmtp.LIBMTP_Delete_Object(self.open_device.device, entry.get_id())
+                err = self.__delete_object(entry.get_id())
                 if err != 0:
                     self.log.error("Delete object %d (%s) failed" % (entry.get_id(), entry.get_path()))
-                else:
-                    if not direntry is None:
-                        direntry.must_refresh = True
-                        direntry.refresh()
+                elif not direntry is None:
+                    direntry.remove_child(name)
         fh = -1
         if type(source) == str or type(source) == unicode:
             if not os.path.exists(source):
@@ -799,25 +1974,24 @@ class MTP:
             try:
                 pfile[0].item_id = 0
                 self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
-                oldhandler = None
-                if not timeout is None:
-                    oldhandler = signal.signal(signal.SIGALRM, timeout_handler)
-                    signal.alarm(timeout)
-                try:
-                    if fh >= 0:
-                        os.lseek(fh, 0, os.SEEK_SET)
-                        err = self.libmtp.LIBMTP_Send_File_From_File_Descriptor(self.open_device.device, fh, pfile,
-                                                                                MTP.PROGRESS_FUNC_P(), c_void_p())
-                    else:
-                        err = self.libmtp.LIBMTP_Send_File_From_File(self.open_device.device,
-                                                                     c_char_p(bytes(source, "utf8")), pfile,
-                                                                     MTP.PROGRESS_FUNC_P(), c_void_p())
-                    signal.alarm(0)
-                finally:
-                    if not oldhandler is None:
-                        signal.signal(signal.SIGALRM, oldhandler)
-                if timeouterr[0] != 0 or err != 0:
-                    if timeout:
+                progress.start(timeout, self.stall_timeout('upload'))
+                if fh >= 0:
+                    os.lseek(fh, 0, os.SEEK_SET)
+                    err = self.libmtp.LIBMTP_Send_File_From_File_Descriptor(self.open_device.device, fh, pfile,
+                                                                            progress.callback, None)
+                else:
+                    err = self.libmtp.LIBMTP_Send_File_From_File(self.open_device.device,
+                                                                 c_char_p(bytes(source, "utf8")), pfile,
+                                                                 progress.callback, None)
+                if progress.cancelled:
+                    # The device may hold the partial object
+                    self.__relist(direntry)
+                    return errno.ECANCELED
+                if progress.timed_out or err != 0:
+                    if progress.stalled_out:
+                        self.log.error("Transfer of %s to %s stalled for %.0f seconds" %
+                                       (str(source), str(target), progress.stall_timeout))
+                    elif timeout:
                         print("Error transferring %s to %s in %d seconds" % (str(source), str(target), timeout))
                     else:
                         print("Error transferring %s to %s" % (str(source), str(target)))
@@ -827,27 +2001,39 @@ class MTP:
                         if recurse == 0:
                             #                  self.log.warn('Resetting device ' +  devno)
                             #                  ret = self.libmtp.LIBMTP_Reset_Device(self.open_device.device)
-                            self.close()
+                            self.close(keep_cache=True)
                             if self.open(devno, must_refresh=False):
-                                return self.copy_to(source, target, timeout, timestamp, recurse=1)
+                                if self.__upload_completed(target, source):
+                                    return 0
+                                return self.copy_to(source, target, timeout, timestamp, recurse=1, progress=progress)
                             else:
                                 recurse = 1
                         if recurse == 1:
                             self.log.error('Reset device failed. Attempting to reopen')
-                            self.close()
+                            self.close(keep_cache=True)
                             if not self.open(devno, must_refresh=True):
                                 self.log.error("Could not reopen device.")
                                 return errno.EINTR
-                            return self.copy_to(source, target, timeout, timestamp, recurse=2)
+                            if self.__upload_completed(target, source):
+                                return 0
+                            return self.copy_to(source, target, timeout, timestamp, recurse=2, progress=progress)
                         if recurse == 2:
                             return errno.EINTR
-                direntry.must_refresh = True
-                direntry.refresh()
+                    # The device is still connected so the folder may hold a partial object
+                    self.__relist(direntry)
+                    return errno.EIO
+                if pfile[0].item_id == 0:
+                    self.log.warning("Send of %s did not return an object id" % (target,))
+                    self.__relist(direntry)
+                elif not direntry is None:
+                    direntry.add_child(pfile[0].item_id, direntry.get_id(), name, False, pfile[0].filesize,
+                                       pfile[0].modificationdate)
                 return 0
             finally:
                 self.__delete_filet(pfile)
         return errno.EIO
 
+    @scheduled(METADATA)
     def mkdir(self, path, recurse=0):
         direntry, entry, _, name = self.__entry_and_dir(path)
         storage = self.get_storage(path)
@@ -858,7 +2044,7 @@ class MTP:
         parentid = direntry.get_id() if not direntry is None else 0
         storageid = direntry.get_storage_id() if not direntry is None else storage.get_id() if not storage is None else 0
         self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
-        newid = self.libmtp.LIBMTP_Create_Folder(self.open_device.device, c_char_p(name),
+        newid = self.libmtp.LIBMTP_Create_Folder(self.open_device.device, c_char_p(bytes(name, "utf8")),
                                                  c_uint32(parentid), c_uint32(storageid))
         if newid <= 0:
             sys.stderr.write(path + ': ')
@@ -867,7 +2053,7 @@ class MTP:
             if not self.check():
                 devno = "%04x:%04x" % (self.open_device.vendor_id, self.open_device.product_id)
                 if recurse == 0:
-                    self.close()
+                    self.close(keep_cache=True)
                     if self.open(devno, must_refresh=True):
                         return self.mkdir(path, recurse=1)
                 if recurse == 1:
@@ -877,99 +2063,369 @@ class MTP:
             else:
                 return False
         if not direntry is None:
-            direntry.must_refresh = True
-            direntry.refresh()
+            dir = direntry.child(direntry.add_child(newid, parentid, name, True, 0, int(time.time())))
+            # A new folder is empty, there is nothing to list
+            dir.must_refresh = False
+            dir.loaded = True
         return True
 
+    @scheduled(METADATA)
     def rmdir(self, path):
         direntry, entry, _, _ = self.__entry_and_dir(path)
         if entry is None or not entry.is_directory():
             return False
-        self.last_error = self.libmtp.LIBMTP_Delete_Object(self.open_device.device, entry.get_id())
-        if not direntry is None and direntry.is_directory():
-            direntry.must_refresh = True
-            direntry.refresh()
+        self.last_error = self.__delete_object(entry.get_id())
+        if self.last_error == 0:
+            if not direntry is None and direntry.is_directory():
+                direntry.remove_child(entry.get_name())
+            self.folders.pop((entry.get_storage_id(), entry.get_id()), None)
             self.remove_path(path)
         return self.last_error == 0
 
+    @scheduled(METADATA)
     def rm(self, entry):
         if type(entry) == str or type(entry) == unicode:
             entry = self.get_path(entry)
         if entry is None or entry.is_directory():
             return False
         parententry = self.get_path(os.path.split(entry.get_path())[0])
-        self.last_error = self.libmtp.LIBMTP_Delete_Object(self.open_device.device, entry.get_id())
-        if not parententry is None and parententry.is_directory():
-            parententry.must_refresh = True
+        self.last_error = self.__delete_object(entry.get_id())
+        if self.last_error == 0 and not parententry is None and parententry.is_directory():
+            parententry.remove_child(entry.get_name())
             self.remove_path(entry.get_path())
         return self.last_error == 0
 
+    @scheduled(METADATA)
     def rename(self, oldpath, newpath):
-        oldentry = self.get_path(oldpath)
-        if oldentry is None:
+        '''
+        Rename and/or move oldpath to newpath on the device. Moves use MoveObject, an existing newpath (a file or
+        an empty folder) is deleted first. Only when the device cannot move objects is a file moved by copying
+        it through a local temporary file. The cached listings are updated in place.
+        '''
+        olddirentry, oldentry, _, _ = self.__entry_and_dir(oldpath)
+        if oldentry is None or olddirentry is None:
             return False
-        dirpath, name = os.path.split(oldpath)
-        olddirentry = self.get_path(dirpath)
-        newname = os.path.split(newpath)[1]
-        newentry = self.get_path(newpath)
-        if not newentry is None is None and newentry.is_directory() and newentry.object_count() > 0:
+        newdirentry, newentry, _, newname = self.__entry_and_dir(newpath)
+        if newdirentry is None or not newdirentry.is_directory():
             return False
-        dirpath, name = os.path.split(newpath)
-        newdirentry = self.get_path(dirpath)
-        isok = False
-        localbackup = None
-        fh = -1
-        try:
-            if not newentry is None and not newentry.is_directory():
-                name, ext = os.path.splitext(os.path.split(newpath)[1])
-                (fh, localbackup) = tempfile.mkstemp(prefix=name, suffix=ext)
-                self.libmtp.LIBMTP_Get_File_To_File_Descriptor(self.open_device.device, newentry.get_id(), fh,
-                                                               MTP.PROGRESS_FUNC_P(), c_void_p())
-                self.libmtp.LIBMTP_Delete_Object(self.open_device.device, newentry.get_id())
-            err = -1
+        if not newentry is None:
+            if newentry.get_id() == oldentry.get_id():
+                return True
+            if newentry.is_directory() != oldentry.is_directory():
+                return False
+            if newentry.is_directory() and newentry.object_count() > 0:
+                return False
+        moving = newdirentry.get_id() != olddirentry.get_id() or \
+                 newdirentry.get_storage_id() != olddirentry.get_storage_id()
+        if moving and (newdirentry.get_storage_id() != oldentry.get_storage_id() or
+                       not self.supports(LIBMTP_DEVICECAP_MoveObject)):
             if oldentry.is_directory():
-                pfolder = self.__new_foldert(olddirentry, oldentry)
+                return False
+            return self.__move_by_copy(oldpath, oldentry, newpath)
+        if not newentry is None:
+            self.last_error = self.__delete_object(newentry.get_id())
+            if self.last_error != 0:
+                return False
+            newdirentry.remove_child(newname)
+            if newentry.is_directory():
+                self.folders.pop((newentry.get_storage_id(), newentry.get_id()), None)
+                self.remove_path(newpath)
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        if moving:
+            err = self.libmtp.LIBMTP_Move_Object(self.open_device.device, c_uint32(oldentry.get_id()),
+                                                 c_uint32(newdirentry.get_storage_id()),
+                                                 c_uint32(newdirentry.get_id()))
+            if err != 0:
+                self.last_error = err
+                self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+                return False
+        if newname != oldentry.get_name():
+            if oldentry.is_directory():
+                pfolder = self.__new_foldert(newdirentry, oldentry)
                 try:
-                    err = self.libmtp.LIBMTP_Set_Folder_Name(self.open_device.device, pfolder, c_char_p(newname))
+                    err = self.libmtp.LIBMTP_Set_Folder_Name(self.open_device.device, pfolder,
+                                                             c_char_p(bytes(newname, "utf8")))
                 finally:
                     self.__delete_foldert(pfolder)
             else:
-                pfile = self.__new_filet(olddirentry, oldentry)
+                pfile = self.__new_filet(newdirentry, oldentry)
                 try:
-                    pname = self.__malloc_string(name)  # POINTER(c_char)
-                    if not pname is None and bool(pname):
-                        pfile[0].name = cast(pname, c_char_p)
-                    err = self.libmtp.LIBMTP_Set_File_Name(self.open_device.device, pfile, c_char_p(newname))
+                    # LIBMTP_Set_File_Name frees the name and strdups the new one, so it must be malloc()ed
+                    pname = self.__malloc_string(oldentry.get_name())
+                    pfile[0].name = cast(pname, c_char_p) if not pname is None else c_char_p()
+                    err = self.libmtp.LIBMTP_Set_File_Name(self.open_device.device, pfile,
+                                                           c_char_p(bytes(newname, "utf8")))
                 finally:
                     self.__delete_filet(pfile)
-            isok = (err == 0)
+            if err != 0:
+                self.last_error = err
+                self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+                if moving:
+                    # Moved under the old name
+                    self.__move_cached(oldentry, olddirentry, newdirentry,
+                                       os.path.join(newdirentry.get_path(), oldentry.get_name()))
+                return False
+        self.last_error = 0
+        self.__move_cached(oldentry, olddirentry, newdirentry, newpath)
+        return True
+
+    @scheduled(FOREGROUND)
+    def copy_object(self, source, target):
+        '''
+        Copy the file source to target on the device. Uses CopyObject, so the data does not cross USB, and
+        falls back to a download and upload through a local temporary file when the device cannot copy
+        objects. An existing target file is replaced. Returns 0 or an errno value.
+        '''
+        _, oldentry, _, _ = self.__entry_and_dir(source)
+        if oldentry is None:
+            return errno.ENOENT
+        if oldentry.is_directory():
+            return errno.EISDIR
+        newdirentry, newentry, _, newname = self.__entry_and_dir(target)
+        if newdirentry is None or not newdirentry.is_directory():
+            return errno.ENOENT
+        if not newentry is None:
+            if newentry.is_directory():
+                return errno.EISDIR
+            if newentry.get_id() == oldentry.get_id():
+                return 0
+        if not self.supports(LIBMTP_DEVICECAP_CopyObject):
+            return self.__copy_by_transfer(source, oldentry, target)
+        if not newentry is None:
+            if newentry.get_id() >= 0 and self.__delete_object(newentry.get_id()) != 0:
+                return errno.EIO
+            newdirentry.remove_child(newname)
+        if newdirentry.must_refresh:
+            newdirentry.refresh()
+        before = set(newdirentry.listing.ids[row] for row in newdirentry.listing.rows())
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        err = self.libmtp.LIBMTP_Copy_Object(self.open_device.device, c_uint32(oldentry.get_id()),
+                                             c_uint32(newdirentry.get_storage_id()), c_uint32(newdirentry.get_id()))
+        if err != 0:
             self.last_error = err
-        finally:
+            self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+            return errno.EIO
+        # CopyObject does not return the handle of the copy, find it in a relist of the target folder
+        self.__relist(newdirentry)
+        listing = newdirentry.listing
+        rows = [row for row in listing.rows(MTPListing.FILE) if not listing.ids[row] in before and
+                listing.name(row) == oldentry.get_name()]
+        if len(rows) != 1:
+            self.log.warning("Could not find the copy of %s in %s" % (source, newdirentry.get_path()))
+            return errno.EIO
+        copied = newdirentry.child(rows[0])
+        if newname != oldentry.get_name():
+            pfile = self.__new_filet(newdirentry, copied)
             try:
-                if fh >= 0 and self.__close(fh):
-                    fh = -1
-                if not isok and not localbackup is None:
-                    fh = os.open(localbackup, 'r')
-                    if fh < 0:
-                        return False
-                    pfile = self.__new_filet(newdirentry, newentry, handle=fh)
-                    try:
-                        ret = self.libmtp.LIBMTP_Send_File_From_File_Descriptor(self.open_device.device, fh, pfile,
-                                                                                MTP.PROGRESS_FUNC_P(), c_void_p())
-                        isok = (ret == 0)
-                    finally:
-                        self.__delete_filet(pfile)
+                # LIBMTP_Set_File_Name frees the name and strdups the new one, so it must be malloc()ed
+                pname = self.__malloc_string(copied.get_name())
+                pfile[0].name = cast(pname, c_char_p) if not pname is None else c_char_p()
+                err = self.libmtp.LIBMTP_Set_File_Name(self.open_device.device, pfile,
+                                                       c_char_p(bytes(newname, "utf8")))
             finally:
-                if fh >= 0:
-                    self.__close(fh)
-                if not localbackup is None:
-                    os.remove(localbackup)
-                if not olddirentry is None and olddirentry.is_directory():
-                    olddirentry.must_refresh = True
-                if not newdirentry is None and newdirentry.is_directory():
-                    newdirentry.must_refresh = True
-        return isok
+                self.__delete_filet(pfile)
+            if err != 0:
+                self.last_error = err
+                self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+                self.__delete_object(copied.get_id())
+                newdirentry.remove_child(copied.get_name())
+                return errno.EIO
+            newdirentry.remove_child(copied.get_name())
+            newdirentry.add_child(copied.get_id(), newdirentry.get_id(), newname, False, copied.get_length(),
+                                  copied.get_timestamp())
+        return 0
+
+    def __copy_by_transfer(self, source, oldentry, target):
+        name, ext = os.path.splitext(oldentry.get_name())
+        fh, localcopy = tempfile.mkstemp(prefix=name, suffix=ext)
+        try:
+            err = self.copy_from(source, fh)
+            if err == 0:
+                err = self.copy_to(fh, target, timestamp=oldentry.get_timestamp())
+        finally:
+            os.close(fh)
+            os.remove(localcopy)
+        return err
+
+    def __move_by_copy(self, oldpath, oldentry, newpath):
+        ''' Move a file by downloading it to a temporary file, uploading that and deleting the original '''
+        self.last_error = self.__copy_by_transfer(oldpath, oldentry, newpath)
+        return self.last_error == 0 and self.rm(oldpath)
+
+    def __move_cached(self, entry, olddirentry, newdirentry, newpath):
+        ''' Move entry from the cached listing of olddirentry to newdirentry, with the paths of cached descendants '''
+        oldpath = entry.get_path()
+        olddirentry.remove_child(entry.get_name())
+        row = newdirentry.add_child(entry.get_id(), newdirentry.get_id(), os.path.split(newpath)[1],
+                                    entry.is_directory(), entry.get_length(), entry.get_timestamp())
+        if not entry.is_directory():
+            return
+        storage = self.get_storage(oldpath)
+        for folder in list(self.folders.values()):
+            path = folder.get_path()
+            if folder is entry or path.startswith(oldpath + os.sep):
+                if not storage is None:
+                    storage.remove_entry(path)
+                folder.path = newpath + path[len(oldpath):]
+                for child in folder.entries.values():
+                    if not child.is_directory():
+                        child.path = os.path.join(folder.path, os.path.split(child.path)[1])
+        entry.folderid = newdirentry.get_id()
+        newdirentry.entries[row] = entry
+
+    @scheduled(BACKGROUND)
+    def edit_object(self, entry, fh, ranges, length):
+        '''
+        Change the file entry in place instead of uploading all of it: the [start, end) ranges are sent from the
+        local file fh with SendPartialObject and the object is then truncated to length. Only for devices that
+        support editing. Returns 0 or an errno value; after an error the object may be partly changed.
+        '''
+        if not self.supports_editing():
+            return errno.EOPNOTSUPP
+        err = self.begin_edit(entry)
+        if err != 0:
+            return err
+        sent = 0
+        start_time = time.time()
+        try:
+            for start, end in ranges:
+                pos = start
+                while pos < end and err == 0:
+                    os.lseek(fh, pos, os.SEEK_SET)
+                    data = os.read(fh, min(TRANSFER_CHUNK_SIZE, end - pos))
+                    if len(data) == 0:
+                        err = errno.EIO
+                        break
+                    err = self.send_partial_object(entry, pos, data)
+                    pos += len(data)
+                    sent += len(data)
+        finally:
+            err = self.end_edit(entry, length, err)
+        if err != 0:
+            self.log.error("Editing %s in place failed" % (entry.get_path(),))
+            return err
+        self.log.debug("Edited %s in place: %d bytes in %d ranges in %.2fs" %
+                       (entry.get_path(), sent, len(ranges), time.time() - start_time))
+        return 0
+
+    @scheduled(BACKGROUND)
+    def begin_edit(self, entry):
+        ''' Start changing entry in place with send_partial_object, see end_edit. Returns 0 or an errno value '''
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        if self.libmtp.LIBMTP_BeginEditObject(self.open_device.device, c_uint32(entry.get_id())) != 0:
+            self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+            return errno.EIO
+        return 0
+
+    @scheduled(BACKGROUND)
+    def send_partial_object(self, entry, offset, data):
+        ''' Write data at offset (at most the current size of the object) between begin_edit and end_edit '''
+        buf = create_string_buffer(data, len(data))
+        if self.libmtp.LIBMTP_SendPartialObject(self.open_device.device, c_uint32(entry.get_id()), c_uint64(offset),
+                                                cast(buf, POINTER(c_ubyte)), c_uint(len(data))) != 0:
+            self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+            return errno.EIO
+        return 0
 
+    @scheduled(BACKGROUND)
+    def end_edit(self, entry, length, err=0):
+        '''
+        Truncate the object to length if it got shorter (unless err, the error of the edit so far, is set) and end
+        the edit. The cached listing is updated to length. Returns err or the first error of these steps.
+        '''
+        device = self.open_device.device
+        objectid = c_uint32(entry.get_id())
+        if err == 0 and length < entry.get_length():
+            if self.libmtp.LIBMTP_TruncateObject(device, objectid, c_uint64(length)) != 0:
+                err = errno.EIO
+        if self.libmtp.LIBMTP_EndEditObject(device, objectid) != 0 and err == 0:
+            err = errno.EIO
+        self.block_cache.invalidate(entry.get_id())
+        if err != 0:
+            self.libmtp.LIBMTP_Dump_Errorstack(device)
+            return err
+        direntry = self.get_path(os.path.split(entry.get_path())[0])
+        if not direntry is None and direntry.is_directory():
+            direntry.add_child(entry.get_id(), direntry.get_id(), entry.get_name(), False, length, int(time.time()))
+        return 0
+
+    @scheduled(BACKGROUND)
+    def send_from_handler(self, target, size, get_func, progress, timestamp=None):
+        '''
+        Create the file target from exactly size bytes supplied by get_func (a DATA_GET_FUNC_P) while they are
+        sent, replacing an existing file. Returns (0 or an errno value, the new MTPFile or None).
+        '''
+        direntry, entry, _, name = self.__entry_and_dir(target)
+        if direntry is None or not direntry.is_directory():
+            return errno.ENOENT, None
+        if not entry is None:
+            if entry.is_directory():
+                return errno.EISDIR, None
+            if entry.get_id() >= 0 and self.__delete_object(entry.get_id()) != 0:
+                return errno.EIO, None
+            direntry.remove_child(name)
+        pfile = self.__new_filet(direntry, None, name=name, timestamp=timestamp)
+        try:
+            pfile[0].filetype = MTPType.filetype(name)
+            pfile[0].filesize = size
+            self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+            progress.start(None, self.stall_timeout('upload'))
+            err = self.libmtp.LIBMTP_Send_File_From_Handler(self.open_device.device, get_func, None, pfile,
+                                                            progress.callback, None)
+            if err != 0 or progress.cancelled or pfile[0].item_id == 0:
+                self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+                # The device may hold a partial object
+                self.__relist(direntry)
+                return errno.ECANCELED if progress.cancelled else errno.EIO, None
+            row = direntry.add_child(pfile[0].item_id, direntry.get_id(), name, False, size,
+                                     pfile[0].modificationdate)
+            return 0, direntry.child(row)
+        finally:
+            self.__delete_filet(pfile)
+
+    def upload_stream(self, target, size=None):
+        '''
+        Start uploading target from data that is still being written, see MTPUploadStream. Returns the
+        MTPUploadStream or None if the device cannot append to objects (supports_editing), as it then could
+        only take the file in one call that blocks every other device call until the writer is done.
+        '''
+        if not self.supports_editing():
+            return None
+        stream = MTPUploadStream(self, target, size)
+        stream.start()
+        return stream
+
+    @scheduled(METADATA)
+    def set_timestamp(self, path, timestamp):
+        '''
+        Set the modification date of a file through its DateModified object property, so nothing is transferred.
+        Returns False if the device does not support (or refuses) that for this type of file.
+        '''
+        direntry, entry, _, name = self.__entry_and_dir(path)
+        if entry is None or entry.is_directory() or entry.get_id() < 0:
+            return False
+        key = (LIBMTP_PROPERTY_DateModified, MTPType.filetype(name))
+        if not key in self.capabilities:
+            self.capabilities[key] = self.libmtp.LIBMTP_Is_Property_Supported(
+                self.open_device.device, LIBMTP_PROPERTY_DateModified, key[1]) == 1
+        if not self.capabilities[key]:
+            return False
+        # MTP dates are local time, as libmtp assumes when it reads modificationdate
+        date = time.strftime("%Y%m%dT%H%M%S", time.localtime(timestamp))
+        self.libmtp.LIBMTP_Clear_Errorstack(self.open_device.device)
+        err = self.libmtp.LIBMTP_Set_Object_String(self.open_device.device, c_uint32(entry.get_id()),
+                                                   LIBMTP_PROPERTY_DateModified, c_char_p(bytes(date, "ascii")))
+        if err != 0:
+            self.log.warning("Setting the modification date of %s failed, not trying again for this file type" %
+                             (path,))
+            self.libmtp.LIBMTP_Dump_Errorstack(self.open_device.device)
+            self.capabilities[key] = False
+            return False
+        if not direntry is None and direntry.is_directory():
+            direntry.add_child(entry.get_id(), direntry.get_id(), name, False, entry.get_length(), int(timestamp))
+        return True
+
+    @scheduled(METADATA)
     def get_dir_by_id(self, storageid, folderid):
         pfolders = None
         find_folders = self.libmtp.LIBMTP_Get_Folder_List_For_Storage
@@ -993,6 +2449,16 @@ class MTP:
     def get_last_error(self):
         return self.last_error
 
+    def __relist(self, direntry):
+        ''' Full relist of a folder, only used when libmtp leaves the cached listing inconsistent '''
+        if not direntry is None and direntry.is_directory():
+            direntry.must_refresh = True
+            direntry.refresh(from_device=True)
+
+    def __delete_object(self, objectid):
+        self.block_cache.invalidate(objectid)
+        return self.libmtp.LIBMTP_Delete_Object(self.open_device.device, objectid)
+
     def __entry_and_dir(self, path):
         dirpath, name = os.path.split(path)
         entry = self.get_path(path)
@@ -1017,7 +2483,7 @@ class MTP:
             # Must use malloc at least for the case of LIBMTP_Set_Folder_Name because it frees name and strdups the new name
             pname = self.__malloc_string(name)  # POINTER(c_char)
             if not pname is None and bool(pname):
-                pfolder.name = cast(pname, c_char_p)
+                pfolder[0].name = cast(pname, c_char_p)
         return pfolder
 
     def __new_filet(self, direntry=None, entry=None, handle=-1, localpath=None, name=None, timestamp=None):
@@ -1051,8 +2517,9 @@ class MTP:
             else:
                 pfile[0].filetype = MTPType.filetype(name)
         if not name is None:
-            bname = bytes(name, 'utf8')
-            pfile[0].name = cast(create_string_buffer(bname), c_char_p)
+            # Owned by Python: kept alive with pfile and taken out again by __delete_filet
+            pfile.python_name = create_string_buffer(bytes(name, 'utf8'))
+            pfile[0].name = cast(pfile.python_name, c_char_p)
 
         if not direntry is None:
             pfile[0].parent_id = direntry.get_id()
@@ -1082,7 +2549,12 @@ class MTP:
 
     def __delete_filet(self, pfile):
         if bool(pfile):
-            pfile[0].name = c_char_p()  # LIBMTP_destroy_file_t assumes name was malloced and frees it so set to NULL
+            # LIBMTP_destroy_file_t frees the name. Only a name libmtp set (LIBMTP_Set_File_Name strdups the new
+            # one) or a __malloc_string is freed, one __new_filet allocated in Python is set to NULL first
+            python_name = getattr(pfile, 'python_name', None)
+            pname = c_void_p.from_address(addressof(pfile[0]) + LIBMTP_file_struct.name.offset)
+            if not python_name is None and pname.value == addressof(python_name):
+                pfile[0].name = c_char_p()
             self.libmtp.LIBMTP_destroy_file_t(pfile)
 
     def __delete_foldert(self, pfolder):
@@ -1090,35 +2562,16 @@ class MTP:
             #         pfolder[0].name = c_char_p()
             self.libmtp.LIBMTP_destroy_folder_t(pfolder)
 
-    def __utftostr(self, s):
-        UTF8Writer = codecs.getwriter('utf8')
-        strstream = StringIO()
-        try:
-            utfout = UTF8Writer(strstream)
-            utfout.write(utf8(s))
-            strstream.flush()
-            return strstream.getvalue()
-        finally:
-            if not strstream is None:
-                try:
-                    strstream.close()
-                except:
-                    pass
-
-                    # please tell me there's a better way to do this
-
     def __malloc_string(self, s):
-        s = self.__utftostr(utf8(s))
+        ''' A malloc()ed, NUL terminated UTF-8 copy of s (POINTER(c_char)) or None '''
+        bs = bytes(s, 'utf8')
         malloc = self.libc.malloc
         malloc.restype = POINTER(c_char)
-        buf = create_string_buffer(s)
-        length = len(s)
-        ps = malloc(length + 1)
+        ps = malloc(len(bs) + 1)
         if not bool(ps):
             return None
-        self.libc.memset(ps, c_int(0), c_size_t(length + 1))  # in case its not Linux which does zero malloced memory
-        for i in range(0, length):
-            ps[i] = buf[i]
+        memmove(ps, bs, len(bs))
+        ps[len(bs)] = b'\0'
         return ps
 
     def __close(self, handle):
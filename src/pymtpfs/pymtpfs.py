@@ -4,7 +4,7 @@ License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
 
 Usage: pymtpfs.py Version 0.0.2
 Interpreter:  2.6 <= Python < 3.0 
-pymtpfs.py [-vDNLes] [device] mountpoint (If device not specified first available device is mounted)
+pymtpfs.py [-vDNLescmREjwu] [device] mountpoint (If device not specified first available device is mounted)
 pymtpfs.py -l (List available devices)
 
 Options:
@@ -30,6 +30,36 @@ Options:
                         Log Level. One of ['DEBUG', 'INFO', 'WARNING', 'ERROR'] 
                         eg -e DEBUG -l, 
                         --list            List available MTP devices and exit
+  -c, --crawl           Crawl all storages in the background after mounting to
+                        pre-populate the directory cache
+  -m METADATA_CACHE, --metadata-cache=METADATA_CACHE
+                        SQLite file used to persist folder listings between
+                        mounts. Listings are served from it immediately and
+                        revalidated against the device in the background
+  -R READ_MODE, --read-mode=READ_MODE
+                        How files opened for reading are fetched. One of
+                        ['full', 'partial', 'stream']. full downloads the whole
+                        file on open, partial reads only the requested ranges
+                        (falls back to full if the device does not support it),
+                        stream downloads in the background and returns from
+                        open at once
+  -E, --events          Track changes made on the device itself by listening
+                        for device events
+  -j UPLOAD_JOURNAL, --upload-journal=UPLOAD_JOURNAL
+                        File recording uploads in progress so that uploads
+                        interrupted by a device reset or a crash are detected
+                        (and not repeated if the device already has them)
+  -w WRITE_BACK, --write-back=WRITE_BACK
+                        Upload files in the background after they are closed
+                        instead of during close. The argument is the maximum
+                        size in Mb of closed files waiting for upload, closing
+                        more blocks until there is room. fsync waits for the
+                        upload eg -w 512
+  -u, --stream-uploads  Send new files to the device while they are written
+                        when they are written sequentially, falling back to
+                        staging them locally when they are not. Needs a
+                        device with the Android edit extension, files on other
+                        devices are always staged
 
 '''
 
@@ -44,6 +74,7 @@ import logging
 import logging.handlers
 import copy
 import shutil
+import threading
 import traceback
 from optparse import OptionParser
 from collections import namedtuple
@@ -59,6 +90,9 @@ except ImportError:
    
 from lru import LRU
 from mtp import MTP
+from crawler import MTPCrawler
+from writeback import MTPWriteBack
+from staging import MTPLazyStage
 
 VERSION = "0.0.2"
 STOPPED = DEBUG = VERBOSE = False
@@ -68,29 +102,51 @@ DIR_ATTRIBUTES = { 'st_atime': 0, 'st_ctime': 0, 'st_gid': os.getgid(),
                 'st_mode': stat.S_IFDIR | 0755, 'st_mtime': 0, 'st_nlink': 1,
                 'st_size': 0, 'st_uid': os.getuid() }
 BAD_FILENAME_CHARS = set(":*?\"<>|")
+READ_MODES = [ 'full', 'partial', 'stream' ]
+THROUGHPUT_XATTR = 'user.pymtpfs.throughput' # Rolling transfer statistics of the device, on the mount root
 
 class MTPFS(LoggingMixIn, Operations):   
-   def __init__(self, mtp, mountpoint, is_debug=False, logger=None):
+   def __init__(self, mtp, mountpoint, is_debug=False, logger=None, crawler=None, read_mode='full', writeback=None, stream_uploads=False):
       global VERBOSE
       self.mtp = mtp
+      self.crawler = crawler
+      self.stream_uploads = stream_uploads # Send new files while they are written sequentially, see MTP.upload_stream
+      self.writeback = writeback # MTPWriteBack uploading released files in the background, None to upload in release
+      self.read_mode = read_mode
       self.is_debug = is_debug
       self.tempdir = tempfile.mkdtemp(prefix='pymtpfs')
       if not bool(self.tempdir) or not os.path.exists(self.tempdir):
          self.tempdir = tempfile.gettempdir()
-      self.read_timeout = 2
-      self.write_timeout = 2      
-      self.openfile_t = namedtuple('openfile', 'handle, path, mtp_path, readonly')
+      self.openfile_t = namedtuple('openfile', 'handle, path, mtp_path, readonly, entry, download, lock, stage, stream')
       self.openfiles = {}
       self.log = logger
       self.created = LRU(1000) 
+      self.created_lock = threading.Lock() # FUSE runs multithreaded, device calls are serialised by mtp.executor
       if VERBOSE:         
          print("Mounted %s on %s" % (self.mtp, ))
       self.log.info("Mounted %s on %s" % (self.mtp, mountpoint))
    
    def __openfile_by_path(self, path):
-      return next((en for en in self.openfiles.values() if en.mtp_path == path), None)
+      return next((en for en in list(self.openfiles.values()) if en.mtp_path == path), None)
 
    def destroy(self, path):
+      if not self.crawler is None:
+         self.crawler.stop()
+      throughput = self.mtp.throughput_stats()
+      if not throughput is None:
+         self.log.info(str(throughput))
+      for name, stats in sorted(self.mtp.scheduler_stats().items()):
+         self.log.info("Device %s calls: %d submitted, %d queued, average wait %.3fs, max wait %.3fs" %
+                       (name, stats['submitted'], stats['queued'], stats['wait_average'], stats['wait_max']))
+      for openfile in self.openfiles.values():
+         if not openfile.download is None:
+            openfile.download.cancel()
+         if not openfile.stream is None:
+            openfile.stream.cancel()
+      keep_tempdir = False
+      if not self.writeback is None and self.writeback.stop() != 0:
+         self.log.error("Some write-back uploads failed, their data is kept in %s" % (self.tempdir,))
+         keep_tempdir = True
       self.mtp.close()
       for openfile in self.openfiles.values():
          try:
@@ -98,7 +154,7 @@ class MTPFS(LoggingMixIn, Operations):
          except:
             self.log.exception("")
       try:
-         if self.tempdir != tempfile.gettempdir():
+         if self.tempdir != tempfile.gettempdir() and not keep_tempdir:
             shutil.rmtree(self.tempdir)
       except:
          self.log.exception("")
@@ -114,9 +170,13 @@ class MTPFS(LoggingMixIn, Operations):
    def getattr(self, path, fh=None):
       attrib = {}
       path = fix_path(path, self.log)
+      if not self.writeback is None:
+         pending = self.writeback.pending(path)
+         if not pending is None:
+            return pending.get_attributes()
       entry = self.mtp.get_path(path)
       if entry is None:
-         entry = self.created.get(path)
+         entry = self.__created(path)
       if entry is None:         
          raise FuseOSError(errno.ENOENT)
       else:
@@ -135,32 +195,42 @@ class MTPFS(LoggingMixIn, Operations):
       return attrib      
    
    def getxattr(self, path, name, position=0):
+      if name == THROUGHPUT_XATTR and fix_path(path, self.log).strip(os.sep) == '':
+         stats = self.mtp.throughput_stats()
+         return "No transfers\n" if stats is None else str(stats)
       return ""
 
+   def listxattr(self, path):
+      if fix_path(path, self.log).strip(os.sep) == '':
+         return [ THROUGHPUT_XATTR ]
+      return []
+
    def create(self, path, mode):       
       path = fix_path(path, self.log)
       (fh, localpath) = self.__get_local_file(path)
       if fh < 0:
          raise FuseOSError(errno.EIO)
-      openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=False)
+      openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=False, entry=None, download=None, lock=threading.Lock(), stage=None, stream=None)
       self.openfiles[fh] = openfile
       newfile = self.mtp.create(path)
-      self.created[path] = newfile 
+      with self.created_lock:
+         self.created[path] = newfile 
       return fh
       
    def open(self, path, flags):
       path = fix_path(path, self.log)
       is_readonly = ((flags & (os.O_WRONLY | os.O_RDWR)) == 0)
       ok = True
+      self.__barrier(path)
       (fh, localpath) = self.__get_local_file(path)
       if fh < 0:
          raise FuseOSError(errno.EIO)
       try:
          entry = self.mtp.get_path(path)
          if entry is None:
-            entry = self.created.get(path)
+            entry = self.__created(path)
             if not entry is None:               
-               openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=is_readonly)
+               openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=is_readonly, entry=None, download=None, lock=threading.Lock(), stage=None, stream=None)
                self.openfiles[fh] = openfile      
                return fh         
          if entry is None and is_readonly:
@@ -169,14 +239,30 @@ class MTPFS(LoggingMixIn, Operations):
          if not entry is None and entry.is_directory():
             ok = False
             raise FuseOSError(errno.EISDIR)
-         copyerr = self.mtp.copy_from(path, fh, timeout=self.__read_timeout(entry.get_length()))
-         if copyerr != 0:
-            if copyerr == errno.ENOENT and not is_readonly:
-               pass
-            else:
+         if is_readonly and self.read_mode == 'partial' and self.mtp.supports_partial_reads():
+            # Reads are served from the device in blocks, nothing is staged in the local file
+            openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=True, entry=entry, download=None, lock=threading.Lock(), stage=None, stream=None)
+            self.openfiles[fh] = openfile
+            return fh
+         if is_readonly and self.read_mode == 'stream':
+            # Reads wait only until their own range has arrived in the local file
+            download = self.mtp.download(entry, fh)
+            if download is None:
+               ok = False
+               raise FuseOSError(errno.EIO)
+            openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=True, entry=None, download=download, lock=threading.Lock(), stage=None, stream=None)
+            self.openfiles[fh] = openfile
+            return fh
+         stage = None
+         if is_readonly:
+            copyerr = self.mtp.copy_from(path, fh)
+            if copyerr != 0:
                ok = False
                raise FuseOSError(copyerr)
-         openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=is_readonly)
+         elif not entry is None and (flags & os.O_TRUNC) == 0:
+            # Nothing is fetched until a read needs it or the file is uploaded, and then only what was not overwritten
+            stage = MTPLazyStage(self.mtp, entry, fh, self.tempdir)
+         openfile =  self.openfile_t(handle=fh, path=localpath, mtp_path=path, readonly=is_readonly, entry=None, download=None, lock=threading.Lock(), stage=stage, stream=None)
          self.openfiles[fh] = openfile
       finally:
          if not ok:
@@ -198,6 +284,29 @@ class MTPFS(LoggingMixIn, Operations):
             sys.stderr.write('Error: handle %d not found in openfiles' % (fh,))
          self.log.error('Error: handle %d not found in openfiles' % (fh,))
          raise FuseOSError(errno.EBADF)
+      if not openfile.entry is None:
+         data = self.mtp.read(openfile.entry, offset, size)
+         if data is None:
+            self.log.error("Partial read of %d bytes at %d from %s failed" % (size, offset, path))
+            raise FuseOSError(errno.EIO)
+         return data
+      if not openfile.download is None:
+         err = openfile.download.wait_for(offset + size)
+         if err != 0:
+            self.log.error("Download of %s failed before offset %d" % (path, offset + size))
+            raise FuseOSError(err)
+      with openfile.lock: # The seek and read must not interleave with another thread using the same handle
+         if not openfile.stream is None:
+            openfile = self.__unstream(fh, openfile)
+         if not openfile.stage is None:
+            err = openfile.stage.fill()
+            if err != 0:
+               self.log.error("Fetching %s for reading failed" % (path,))
+               raise FuseOSError(err)
+         return self.__read(path, size, offset, fh, openfile)
+
+   def __read(self, path, size, offset, fh, openfile):
+      err = 0
       try:
          if os.lseek(fh, offset, os.SEEK_SET) < 0:
             if VERBOSE:
@@ -248,6 +357,50 @@ class MTPFS(LoggingMixIn, Operations):
             sys.stderr.write('Error: handle %d not found in openfiles' % (fh,))
          self.log.error('Error: handle %d not found in openfiles' % (fh,))
          raise FuseOSError(errno.EBADF)
+      with openfile.lock:
+         if openfile.stream is None and offset == 0 and self.stream_uploads and openfile.stage is None and \
+               os.fstat(fh).st_size == 0:
+            openfile = self.__stream(fh, openfile, None)
+         if not openfile.stream is None:
+            if openfile.stream.write(offset, data):
+               return len(data)
+            openfile = self.__unstream(fh, openfile)
+         n = self.__write(data, offset, fh, openfile)
+         if not openfile.stage is None:
+            openfile.stage.wrote(offset, n)
+         return n
+
+   def __stream(self, fh, openfile, size):
+      ''' Start sending the file while it is written. Returns the open file, updated if streaming started '''
+      self.__barrier(openfile.mtp_path)
+      stream = self.mtp.upload_stream(openfile.mtp_path, size)
+      if stream is None:
+         return openfile
+      openfile = openfile._replace(stream=stream)
+      self.openfiles[fh] = openfile
+      return openfile
+
+   def __unstream(self, fh, openfile):
+      ''' The file is no longer written sequentially (or is read or truncated): stage it locally from here on '''
+      stream = openfile.stream
+      # Nothing was kept locally, what was sent so far stays on the device and is fetched when needed
+      err = stream.finish()
+      if err != 0:
+         self.openfiles[fh] = openfile._replace(stream=None)
+         self.log.error('Streaming upload of %s failed' % (openfile.mtp_path,))
+         raise FuseOSError(err)
+      if not stream.timestamp is None:
+         # A lazily staged file that is not written again is not uploaded, so the time goes to the device now
+         err = self.__set_device_time(openfile.mtp_path, stream.timestamp)
+         if err != 0:
+            self.log.error('Setting the time of %s failed' % (openfile.mtp_path,))
+      stage = MTPLazyStage(self.mtp, stream.entry, fh, self.tempdir)
+      openfile = openfile._replace(stream=None, stage=stage)
+      self.openfiles[fh] = openfile
+      return openfile
+
+   def __write(self, data, offset, fh, openfile):
+      err = 0
       if os.lseek(fh, offset, os.SEEK_SET) < 0:
          if VERBOSE:
             sys.stderr.write('Error: seek error to %d in %s (%s)' % (offset, openfile.path, openfile.mtp_path))
@@ -272,15 +425,55 @@ class MTPFS(LoggingMixIn, Operations):
       path = fix_path(path, self.log)      
       global VERBOSE
       err = 0
+      openfile = self.openfiles.get(fh)
+      if not openfile is None and not openfile.download is None:
+         openfile.download.cancel()
+      unchanged = False
+      if not openfile is None and not openfile.stream is None:
+         with openfile.lock:
+            err = openfile.stream.finish()
+            if err == 0:
+               unchanged = True
+               if not openfile.stream.timestamp is None:
+                  # Asked for by utimens while the file was streamed
+                  err = self.__set_device_time(path, openfile.stream.timestamp)
+      if not openfile is None and not openfile.readonly and not openfile.stage is None:
+         with openfile.lock:
+            stage = openfile.stage
+            if not stage.dirty:
+               unchanged = True # Opened for writing but never written to, the device already has the content
+            elif self.mtp.supports_editing() and self.__barrier(path) == 0:
+               # Send only the changed ranges, the whole file goes if that fails
+               # Lazily staged files can be sparse or short: the object keeps at least what was not truncated
+               length = max(os.fstat(fh).st_size, stage.base)
+               unchanged = self.mtp.edit_object(stage.entry, fh, stage.changed(length), length) == 0
+            if stage.dirty and not unchanged:
+               err = stage.fill()
+      # Forget the handle before closing it, the number can be reused by the next open at once
+      self.openfiles.pop(fh, None)
       try:
          os.close(fh)
       except:
          self.log.exception("")
-      openfile = self.openfiles.get(fh)
+      staged = False
       try:
+         if err != 0:
+            self.log.error('Error writing %s to the device' % (openfile.mtp_path,))
+            raise FuseOSError(err)
          if not openfile is None:
-            if not openfile.readonly:                       
-               err = self.mtp.copy_to(openfile.path, openfile.mtp_path, timeout=self.__write_timeout(os.path.getsize(openfile.path)))
+            if unchanged:
+               with self.created_lock:
+                  if path in self.created:
+                     del self.created[path]
+            elif not openfile.readonly and not self.writeback is None:
+               # Returns at once unless too much is already staged, the queue owns the local file from now on
+               self.writeback.enqueue(openfile.mtp_path, openfile.path)
+               staged = True
+               with self.created_lock:
+                  if path in self.created:
+                     del self.created[path]
+            elif not openfile.readonly:                       
+               err = self.mtp.copy_to(openfile.path, openfile.mtp_path, timestamp=long(os.path.getmtime(openfile.path)))
                if err != 0:
                   if VERBOSE:
                      sys.stderr.write('Error copying %s to %s' % (openfile.path, openfile.mtp_path))
@@ -288,7 +481,8 @@ class MTPFS(LoggingMixIn, Operations):
                   raise FuseOSError(err)  
                else:
                   try:
-                     self.created.__delitem__(path)
+                     with self.created_lock:
+                        self.created.__delitem__(path)
                   except:
                      pass       
          else:
@@ -297,9 +491,45 @@ class MTPFS(LoggingMixIn, Operations):
             self.log.error('Error: handle %d not found in openfiles' % (fh,))            
             raise FuseOSError(errno.EBADF)
       finally:
-         self.__del(openfile.path)
+         if not openfile is None and not staged:
+            self.__del(openfile.path)
       return 0
    
+   def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out, offset_out, length, flags):
+      ''' Whole file copies from a file opened read only into a new empty file are done by the device
+          (CopyObject) so the data never crosses USB. Anything else is refused, the kernel then falls back
+          to reading and writing through the staged files. '''
+      path_in = fix_path(path_in, self.log)
+      path_out = fix_path(path_out, self.log)
+      infile = self.openfiles.get(fh_in)
+      outfile = self.openfiles.get(fh_out)
+      if infile is None or outfile is None:
+         raise FuseOSError(errno.EBADF)
+      entry = self.mtp.get_path(path_in)
+      if not entry is None and offset_in >= entry.get_length():
+         return 0 # Callers keep copying until a call at the end of the source copies nothing
+      if outfile.readonly:
+         raise FuseOSError(errno.EBADF)
+      if not infile.readonly or entry is None or offset_in != 0 or offset_out != 0 or length < entry.get_length():
+         raise FuseOSError(errno.EOPNOTSUPP)
+      with outfile.lock:
+         if os.fstat(fh_out).st_size != 0 or (not outfile.stage is None and outfile.stage.base > 0) or \
+               not outfile.stream is None:
+            raise FuseOSError(errno.EOPNOTSUPP)
+         err = self.mtp.copy_object(path_in, path_out)
+         if err != 0:
+            raise FuseOSError(err)
+         copied = self.mtp.get_path(path_out)
+         if copied is None:
+            raise FuseOSError(errno.EIO)
+         # The device holds the copy: staged lazily like a file opened for writing, release uploads nothing
+         # unless the copy is then written to
+         self.openfiles[fh_out] = outfile._replace(stage=MTPLazyStage(self.mtp, copied, fh_out, self.tempdir))
+      with self.created_lock:
+         if path_out in self.created:
+            del self.created[path_out]
+      return entry.get_length()
+
    def flush(self, path, fh):
       return self.fsync(path, 0, fh)
   
@@ -307,6 +537,9 @@ class MTPFS(LoggingMixIn, Operations):
       err = 0        
       oldpath = fix_path(oldpath, self.log)
       newpath = fix_path(newpath, self.log)
+      self.__barrier(oldpath)
+      if not self.writeback is None:
+         self.writeback.discard(newpath)
       oldentry = self.mtp.get_path(oldpath)
       if oldentry is None:
          raise FuseOSError(errno.ENOENT)      
@@ -329,11 +562,13 @@ class MTPFS(LoggingMixIn, Operations):
       except OSError, e:
          err = e.errno
          self.log.exception(path)
+      if err == 0:
+         err = self.__barrier(path)
 #      if err == 0:
 #         try:
 #            openfile = self.openfiles.get(fh)
 #            if not openfile is None and not openfile.readonly:
-#               err = self.mtp.copy_to(openfile.path, openfile.mtp_path, timeout=self.__write_timeout(os.path.getsize(openfile.path)))
+#               err = self.mtp.copy_to(openfile.path, openfile.mtp_path)
 #               if err != 0:            
 #                  if VERBOSE:
 #                     sys.stderr.write('Error copying %s to %s' % (openfile.path, openfile.mtp_path))
@@ -391,20 +626,13 @@ class MTPFS(LoggingMixIn, Operations):
             if not folder.is_directory():
                sys.stderr.write('%s is not a directory' % (path,))
             else:
-               for en in folder.get_directories():
+               for (name, attributes) in folder.get_child_attributes():
                   try:
-                     name = utf8(en.get_name())
+                     name = utf8(name)
                   except:
-                     self.log.exception(en.get_name())
-                     continue
-                  contents.append( (name, en.get_attributes(), offset) )
-               for en in folder.get_files():
-                  try:
-                     name = utf8(en.get_name())
-                  except:                     
-                     self.log.exception(en.get_name())
+                     self.log.exception(name)
                      continue
-                  contents.append( (name, en.get_attributes(), offset) )
+                  contents.append( (name, attributes, offset) )
          return contents
       except OSError, e:
          self.log.exception("")
@@ -416,6 +644,8 @@ class MTPFS(LoggingMixIn, Operations):
 
    def unlink(self, path):
       path = fix_path(path, self.log)
+      if not self.writeback is None:
+         self.writeback.discard(path)
       entry = self.mtp.get_path(path)
       if entry is None:
          raise FuseOSError(errno.ENOENT)
@@ -437,24 +667,29 @@ class MTPFS(LoggingMixIn, Operations):
          openfile = self.openfiles.get(fh)
       localpath = None      
       if openfile is None:         
-         (fh, localpath) = self.__get_local_file(path)
-         if fh < 0:
-            raise FuseOSError(errno.EIO)         
+         self.__barrier(path)
          entry = self.mtp.get_path(path)
          is_created = False
          if entry is None:
-            entry = self.created.get(path)
+            entry = self.__created(path)
             is_created = (not entry is None)
          if entry is None:
             raise FuseOSError(errno.ENOENT)
          if entry.is_directory():
             raise FuseOSError(errno.EISDIR)
-         if not is_created:                  
-            err = self.mtp.copy_from(path, fh, timeout=self.__read_timeout(entry.get_length()))
+         if not is_created and entry.get_length() == length:
+            return 0
+         (fh, localpath) = self.__get_local_file(path)
+         if fh < 0:
+            raise FuseOSError(errno.EIO)         
+         if not is_created:
+            # Only the part of the object that survives the truncation is fetched, nothing at all for length 0
+            stage = MTPLazyStage(self.mtp, entry, fh, self.tempdir)
+            stage.truncated(length)
+            err = stage.fill()
          if err != 0:
             raise FuseOSError(err)
-      os.ftruncate(fh, length)
-      if openfile is None and not localpath is None and fh >= 0:
+         os.ftruncate(fh, length)
          try:
             os.lseek(fh, 0, os.SEEK_SET) 
          except OSError, e:
@@ -462,7 +697,7 @@ class MTPFS(LoggingMixIn, Operations):
             err = e.errno
          if  err < 0:
             raise FuseOSError(errno.EIO)                  
-         err = self.mtp.copy_to(fh, path, timeout=self.__write_timeout(length))
+         err = self.mtp.copy_to(fh, path)
          if err != 0 :
             raise FuseOSError(err)
          try:
@@ -470,33 +705,79 @@ class MTPFS(LoggingMixIn, Operations):
          except:
             self.log.exception("")
          os.remove(localpath)                  
+      else:
+         with openfile.lock:
+            if not openfile.stream is None:
+               openfile = self.__unstream(fh, openfile)
+            elif self.stream_uploads and not openfile.readonly and openfile.stage is None and length > 0 and \
+                  os.fstat(fh).st_size == 0:
+               # The size was reserved before the first write so the file can be sent while it is written
+               openfile = self.__stream(fh, openfile, length)
+            os.ftruncate(fh, length)
+            if not openfile.stage is None:
+               openfile.stage.truncated(length)
       return 0
 
    def utimens(self, path, times=None):
       path = fix_path(path, self.log)
       err = 0
+      ts = long(time.time()) if times is None else times[1] if len(times) > 1 else times[0] if len(times) > 0 else long(time.time())  
+      # Cheapest first: a queued upload or an open file that will be uploaded anyway takes the time along
+      if not self.writeback is None and self.writeback.set_mtime(path, ts):
+         return 0
+      self.__barrier(path)
+      openfile = self.__openfile_by_path(path)
+      if not openfile is None and not openfile.readonly:
+         with openfile.lock:
+            if not openfile.stream is None:
+               openfile.stream.timestamp = ts # Set on the device once release has finished the stream
+               return 0
+            try:
+               os.utime(openfile.path, (ts, ts))
+               if openfile.stage is None or openfile.stage.dirty:
+                  return 0 # Uploaded on release with the time of the local file
+            except OSError:
+               pass # Released meanwhile, set the time on the device
       entry = self.mtp.get_path(path)
       if entry is None:
-         entry = self.created.get(path)
+         entry = self.__created(path)
          if not entry is None:
             return
       if entry is None:
          raise FuseOSError(errno.ENOENT)
       if entry.is_directory():
          return 0 # No-op as LIBMTP_folder_struct has no time fields
+      err = self.__set_device_time(path, ts)
+      if err != 0:
+         raise FuseOSError(err)
+      return 0
+
+   def __set_device_time(self, path, ts):
+      ''' Set the modification time of the device file path. Returns 0 or an errno value '''
+      if self.mtp.set_timestamp(path, ts):
+         return 0
+      # The device cannot set the date on its own, send the file again with the new date
       (fh, localpath) = self.__get_local_file(path)      
-      err = self.mtp.copy_from(path, fh, timeout=self.__read_timeout(entry.get_length()))
+      err = self.mtp.copy_from(path, fh)
       try:
          os.close(fh)
       except OSError, e:
          err = e.errno
       if err == 0:
-         ts = long(time.time()) if times is None else times[1] if len(times) > 1 else times[0] if len(times) > 0 else long(time.time())  
-         err = self.mtp.copy_to(localpath, path, timestamp=ts, timeout=self.__write_timeout(os.path.getsize(localpath)))
-      if err != 0:
-         raise FuseOSError(err)
-      return 0
+         err = self.mtp.copy_to(localpath, path, timestamp=ts)
+      self.__del(localpath)
+      return err
       
+   def __barrier(self, path):
+      ''' Wait for queued write-back uploads of path. Returns 0 or the error of a failed upload '''
+      if self.writeback is None:
+         return 0
+      return self.writeback.wait(path)
+
+   def __created(self, path):
+      with self.created_lock:
+         return self.created.get(path)
+
    def __get_local_file(self, path):
       name, ext = os.path.splitext(os.path.split(path)[1])
       if name.strip() == '':
@@ -519,22 +800,6 @@ class MTPFS(LoggingMixIn, Operations):
          return (fh, localpath, None)
       return (fh, localpath)      
    
-   def __read_timeout(self, length):
-      timeout = None
-      try:
-         timeout = self.read_timeout * length
-         if timeout <= 10:
-            timeout = 10
-      except:
-         timeout = None
-      return timeout
-   
-   def __write_timeout(self, length):
-      timeout = self.write_timeout * length
-      if timeout < 10:
-         timeout = 10
-      return timeout
-   
    def __del(self, path):
       try:
          os.remove(path)
@@ -619,7 +884,7 @@ def main(argv=None):
    if argv is None:
       argv = sys.argv
    usage="""%s Version %s
-%s [-vDNLes] [device] mountpoint (If device not specified first available device is mounted)
+%s [-vDNLescmREjwu] [device] mountpoint (If device not specified first available device is mounted)
 %s -l (List available devices)
 """ % (argv[0], VERSION, argv[0], argv[0])
    parser = OptionParser(usage=usage)
@@ -645,9 +910,41 @@ def main(argv=None):
                      """ % (str(LOG_LEVELS.keys()), LOG_LEVELS.keys()[0]))
    parser.add_option("-l", '--list', action="store_true", dest="list", \
                      help="List available MTP devices and exit", default=False)
+   parser.add_option("-c", '--crawl', action="store_true", dest="crawl", \
+                     help="Crawl all storages in the background after mounting to pre-populate the directory cache", default=False)
+   parser.add_option("-m", '--metadata-cache', dest="metadata_cache", default=None, \
+                     help="""SQLite file used to persist folder listings between mounts. Listings are served
+                     from it immediately and revalidated against the device in the background""")
+   parser.add_option("-R", '--read-mode', dest="read_mode", default="full", \
+                     help="""How files opened for reading are fetched. One of %s. full downloads the whole file
+                     on open, partial reads only the requested ranges (falls back to full if the device
+                     does not support it), stream downloads in the background and returns from open at once""" % (str(READ_MODES),))
+   parser.add_option("-E", '--events', action="store_true", dest="events", \
+                     help="Track changes made on the device itself by listening for device events", default=False)
+   parser.add_option("-j", '--upload-journal', dest="upload_journal", default=None, \
+                     help="""File recording uploads in progress so that uploads interrupted by a device reset or a
+                     crash are detected (and not repeated if the device already has them)""")
+   parser.add_option("-w", '--write-back', dest="write_back", default=None, \
+                     help="""Upload files in the background after they are closed instead of during close. The
+                     argument is the maximum size in Mb of closed files waiting for upload, closing more
+                     blocks until there is room. fsync waits for the upload eg -w 512""")
+   parser.add_option("-u", '--stream-uploads', action="store_true", dest="stream_uploads", \
+                     help="""Send new files to the device while they are written when they are written sequentially,
+                     falling back to staging them locally when they are not. Needs a device with the Android edit
+                     extension, files on other devices are always staged""", default=False)
    (options, args) = parser.parse_args()
    VERBOSE = options.verbose
    DEBUG = options.debug
+   if not options.read_mode in READ_MODES:
+      sys.stderr.write('Argument error for -R (--read-mode) %s. Argument must be one of %s' % (options.read_mode, str(READ_MODES)))
+      return 1
+   write_back_limit = None
+   if not options.write_back is None:
+      try:
+         write_back_limit = int(options.write_back) * 1024 * 1024
+      except ValueError:
+         sys.stderr.write('Argument error for -w (--write-back) %s. Max size must be a integer' % (options.write_back,))
+         return 1
    signal.signal(signal.SIGTERM, signal_handler)
    signal.signal(signal.SIGQUIT, signal_handler)
    mountpoint = deviceid = None
@@ -675,7 +972,13 @@ def main(argv=None):
       parser.print_help()
       return 1             
  
-   mtp = MTP(DEBUG)   
+   metadata_cache = None
+   if not options.metadata_cache is None:
+      metadata_cache = os.path.abspath(options.metadata_cache)
+   upload_journal = None
+   if not options.upload_journal is None:
+      upload_journal = os.path.abspath(options.upload_journal)
+   mtp = MTP(DEBUG, metadata_cache_path=metadata_cache, events=options.events, upload_journal_path=upload_journal)
    if mtp is None:
       print("Could not open MTP")
       return 1
@@ -702,7 +1005,19 @@ def main(argv=None):
          else:
             print mtp
    
-   fuse = FUSE(MTPFS(mtp, mountpoint, is_debug=options.debug, logger=logger), mountpoint, encoding='utf-8', foreground=True, nothreads=True)
+   crawler = None
+   if options.crawl:
+      crawler = MTPCrawler(mtp, on_progress=crawl_progress)
+      crawler.start()
+   writeback = None
+   if not write_back_limit is None:
+      writeback = MTPWriteBack(mtp, write_back_limit)
+   fuse = FUSE(MTPFS(mtp, mountpoint, is_debug=options.debug, logger=logger, crawler=crawler, read_mode=options.read_mode, writeback=writeback, stream_uploads=options.stream_uploads), mountpoint, encoding='utf-8', foreground=True, nothreads=False)
+
+def crawl_progress(progress):
+   global VERBOSE
+   if VERBOSE:
+      print(str(progress))
 
 def fix_path(path, logger=None):
    if any((c in BAD_FILENAME_CHARS) for c in path):
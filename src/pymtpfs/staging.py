@@ -0,0 +1,142 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Lazy staging of files opened for writing. The local copy of the device object starts out empty and only the
+ranges that were neither overwritten nor truncated away are fetched, and only once they are needed: when the
+file is read or when it is uploaded again.
+'''
+
+import errno
+import os
+import tempfile
+
+from executor import FOREGROUND
+
+FILL_CHUNK_SIZE = 1024 * 1024  # GetPartialObject size used to fetch the missing ranges
+
+
+class MTPLazyStage:
+    '''
+    Tracks which bytes of the local file fh stand for the device object entry. Callers serialise access (the
+    open file lock in MTPFS). base is the part of the device object still visible in the file, it shrinks
+    when the file is truncated; written holds the merged [start, end) ranges written locally.
+    '''
+
+    def __init__(self, mtp, entry, fh, tempdir=None):
+        self.mtp = mtp
+        self.entry = entry
+        self.fh = fh
+        self.tempdir = tempdir
+        self.base = entry.get_length()
+        self.written = []
+        self.filled = self.base == 0
+        self.dirty = False
+
+    def wrote(self, offset, size):
+        if size <= 0:
+            return
+        self.dirty = True
+        start, end = offset, offset + size
+        merged = []
+        for (s, e) in self.written:
+            if e < start or s > end:
+                merged.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append((start, end))
+        merged.sort()
+        self.written = merged
+
+    def truncated(self, length):
+        self.dirty = True
+        self.base = min(self.base, length)
+        self.written = [(s, min(e, length)) for (s, e) in self.written if s < length]
+        if self.base == 0:
+            self.filled = True
+
+    def changed(self, length):
+        ''' The [start, end) ranges of a file of length bytes that differ from the device object '''
+        ranges = [(s, min(e, length)) for (s, e) in self.written if s < length]
+        if self.base < length:
+            # Past base the device has nothing (or data that was truncated away) so all of that goes
+            kept, tail = [], self.base
+            for (s, e) in ranges:
+                if e < self.base:
+                    kept.append((s, e))
+                else:
+                    tail = min(tail, s)
+            ranges = kept + [(tail, length)]
+        return ranges
+
+    def missing(self):
+        ''' The [start, end) ranges of the device object that are still to be fetched '''
+        if self.filled:
+            return []
+        gaps = []
+        pos = 0
+        for (s, e) in self.written:
+            if s >= self.base:
+                break
+            if s > pos:
+                gaps.append((pos, s))
+            pos = max(pos, e)
+        if pos < self.base:
+            gaps.append((pos, self.base))
+        return gaps
+
+    def fill(self):
+        ''' Fetch the missing ranges into the local file. Returns 0 or an errno value '''
+        gaps = self.missing()
+        if len(gaps) == 0:
+            self.filled = True
+            return 0
+        if gaps == [(0, self.entry.get_length())]:
+            # Nothing was written yet, a plain download is the fastest way
+            os.lseek(self.fh, 0, os.SEEK_SET)
+            err = self.mtp.copy_from(self.entry.get_path(), self.fh)
+        elif self.mtp.supports_partial_reads():
+            err = self.__fill_partial(gaps)
+        else:
+            err = self.__fill_download(gaps)
+        if err == 0:
+            self.filled = True
+        return err
+
+    def __fill_partial(self, gaps):
+        for (start, end) in gaps:
+            pos = start
+            while pos < end:
+                # Called from FUSE threads, the device is only used from its executor
+                data = self.mtp.executor.call(self.mtp.get_partial_object, self.entry.get_id(), pos,
+                                              min(FILL_CHUNK_SIZE, end - pos), priority=FOREGROUND)
+                if data is None or len(data) == 0:
+                    return errno.EIO
+                self.__write(pos, data)
+                pos += len(data)
+        return 0
+
+    def __fill_download(self, gaps):
+        # Without partial reads the whole object has to come over, the overwritten ranges are then skipped
+        fd, temp = tempfile.mkstemp(prefix='fill', dir=self.tempdir)
+        try:
+            err = self.mtp.copy_from(self.entry.get_path(), fd)
+            if err != 0:
+                return err
+            for (start, end) in gaps:
+                pos = start
+                while pos < end:
+                    os.lseek(fd, pos, os.SEEK_SET)
+                    data = os.read(fd, min(FILL_CHUNK_SIZE, end - pos))
+                    if len(data) == 0:
+                        return errno.EIO
+                    self.__write(pos, data)
+                    pos += len(data)
+            return 0
+        finally:
+            os.close(fd)
+            os.remove(temp)
+
+    def __write(self, offset, data):
+        os.lseek(self.fh, offset, os.SEEK_SET)
+        n = 0
+        while n < len(data):
+            n += os.write(self.fh, data[n:])
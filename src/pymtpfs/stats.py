@@ -0,0 +1,83 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Per transfer throughput records and rolling per device statistics, fed from the libmtp progress callback.
+'''
+
+import threading
+from collections import deque
+
+STATS_WINDOW = 100  # Transfers kept per device for the rolling statistics
+
+
+class MTPTransferRecord:
+    __slots__ = ('direction', 'path', 'bytes', 'seconds', 'first_byte', 'stalls', 'stalled', 'ok')
+
+    def __init__(self, direction, path, bytes, seconds, first_byte, stalls, stalled, ok):
+        self.direction = direction  # 'download' or 'upload'
+        self.path = path
+        self.bytes = bytes
+        self.seconds = seconds
+        self.first_byte = first_byte  # Seconds until the first data arrived, None if none did
+        self.stalls = stalls
+        self.stalled = stalled  # Seconds spent in stalls
+        self.ok = ok
+
+    def rate(self):
+        ''' Bytes per second '''
+        return 0.0 if self.seconds <= 0 else self.bytes / self.seconds
+
+    def __str__(self):
+        return "%s %s: %d bytes in %.2fs (%.0f KiB/s), first byte %s, %d stalls (%.1fs)%s" % \
+               (self.direction, self.path, self.bytes, self.seconds, self.rate() / 1024,
+                '-' if self.first_byte is None else '%.3fs' % (self.first_byte,), self.stalls, self.stalled,
+                '' if self.ok else ', failed')
+
+
+class MTPThroughputStats:
+    ''' The last STATS_WINDOW transfers of one device '''
+
+    def __init__(self, device, window=STATS_WINDOW):
+        self.device = device
+        self.records = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def rate(self, direction):
+        ''' Bytes per second over the successful transfers in direction, 0 if there were none '''
+        with self.lock:
+            records = [record for record in self.records if record.direction == direction and record.ok]
+        seconds = sum(record.seconds for record in records)
+        return 0.0 if seconds <= 0 else sum(record.bytes for record in records) / seconds
+
+    def summary(self):
+        ''' Per direction: transfers, failures, bytes, bytes per second, average time to first byte and stalls '''
+        with self.lock:
+            records = list(self.records)
+        summary = {}
+        for direction in ('download', 'upload'):
+            selected = [record for record in records if record.direction == direction]
+            seconds = sum(record.seconds for record in selected)
+            first_bytes = [record.first_byte for record in selected if not record.first_byte is None]
+            summary[direction] = {
+                'transfers': len(selected),
+                'failures': sum(1 for record in selected if not record.ok),
+                'bytes': sum(record.bytes for record in selected),
+                'bytes_per_second': 0.0 if seconds <= 0 else sum(record.bytes for record in selected) / seconds,
+                'first_byte_average': 0.0 if len(first_bytes) == 0 else sum(first_bytes) / len(first_bytes),
+                'stalls': sum(record.stalls for record in selected),
+                'slowest': min(selected, key=MTPTransferRecord.rate) if len(selected) > 0 else None
+            }
+        return summary
+
+    def __str__(self):
+        lines = ["Device %s, last %d transfers" % (self.device, len(self.records))]
+        for direction, stats in sorted(self.summary().items()):
+            lines.append("%s: %d (%d failed), %d bytes, %.0f KiB/s, first byte %.3fs, %d stalls" %
+                         (direction, stats['transfers'], stats['failures'], stats['bytes'],
+                          stats['bytes_per_second'] / 1024, stats['first_byte_average'], stats['stalls']))
+            if not stats['slowest'] is None:
+                lines.append("slowest %s" % (stats['slowest'],))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,230 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Incremental one way sync between a device folder and a local directory. The device side is compared using
+the cached folder listings (size and modification date) so unchanged objects cost neither a transfer nor a
+device call, and only new or changed files are copied.
+'''
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from executor import BACKGROUND
+from tree import list_tree
+
+DOWNLOAD = 'download'  # device -> local
+UPLOAD = 'upload'  # local -> device
+
+DELETE_KEEP = 'keep'  # Leave files that only exist on the target alone
+DELETE = 'delete'  # Delete them
+DELETE_TRASH = 'trash'  # Move them to a trash directory (local targets only)
+DELETE_POLICIES = (DELETE_KEEP, DELETE, DELETE_TRASH)
+
+MTIME_TOLERANCE = 2  # Seconds, FAT based device storages only keep even seconds
+
+
+class MTPSyncPlan:
+    ''' What a sync would do, as relative paths. updated files exist on both sides but differ '''
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.folders = []
+        self.added = []
+        self.updated = []
+        self.deleted = []
+        self.deleted_folders = []
+        self.unchanged = 0
+        self.bytes = 0
+
+    def __str__(self):
+        lines = ["%s: %d new, %d changed, %d unchanged, %d to delete (%d folders), %d bytes to copy" %
+                 (self.direction, len(self.added), len(self.updated), self.unchanged, len(self.deleted),
+                  len(self.deleted_folders), self.bytes)]
+        lines.extend("mkdir  %s" % (path,) for path in self.folders)
+        lines.extend("new    %s" % (path,) for path in self.added)
+        lines.extend("change %s" % (path,) for path in self.updated)
+        lines.extend("delete %s" % (path,) for path in self.deleted + self.deleted_folders)
+        return '\n'.join(lines) + '\n'
+
+
+class MTPSyncReport:
+    def __init__(self, plan, dry_run):
+        self.plan = plan
+        self.dry_run = dry_run
+        self.copied = 0
+        self.deleted = 0
+        self.errors = []  # (relative path, errno)
+        self.seconds = 0.0
+
+    def __str__(self):
+        if self.dry_run:
+            return "Dry run, nothing changed. " + str(self.plan)
+        return "%s: %d copied, %d deleted, %d errors in %.1fs" % \
+               (self.plan.direction, self.copied, self.deleted, len(self.errors), self.seconds)
+
+
+class MTPSync:
+    '''
+    Mirrors device_path to local_path (DOWNLOAD) or local_path to device_path (UPLOAD). A file is copied
+    when it is missing on the target or its size or modification time (within MTIME_TOLERANCE) differ.
+    Files only present on the target are handled according to the deletion policy.
+    '''
+
+    def __init__(self, mtp, device_path, local_path, direction=DOWNLOAD, deletion=DELETE_KEEP, trash=None,
+                 priority=BACKGROUND):
+        if not deletion in DELETE_POLICIES:
+            raise ValueError("Deletion policy must be one of %s" % (str(DELETE_POLICIES),))
+        if deletion == DELETE_TRASH and direction == UPLOAD:
+            raise ValueError("The trash deletion policy is only supported for local targets")
+        self.mtp = mtp
+        self.device_path = device_path.rstrip(os.sep)
+        self.local_path = local_path
+        self.direction = direction
+        self.deletion = deletion
+        self.trash = trash if not trash is None else os.path.join(local_path, '.pymtpfs-trash')
+        self.priority = priority
+        self.log = logging.getLogger("pymtpfs")
+
+    def plan(self):
+        ''' Compare both sides and return a MTPSyncPlan without changing anything '''
+        device_folders, device_files = self.__device_tree()
+        local_folders, local_files = self.__local_tree()
+        if self.direction == DOWNLOAD:
+            source_folders, source_files, target_folders, target_files = \
+                device_folders, device_files, local_folders, local_files
+        else:
+            source_folders, source_files, target_folders, target_files = \
+                local_folders, local_files, device_folders, device_files
+        plan = MTPSyncPlan(self.direction)
+        plan.folders = sorted(path for path in source_folders if not path in target_folders)
+        for path, (size, mtime) in sorted(source_files.items()):
+            target = target_files.get(path)
+            if target is None:
+                plan.added.append(path)
+            elif target[0] != size or abs(target[1] - mtime) > MTIME_TOLERANCE:
+                plan.updated.append(path)
+            else:
+                plan.unchanged += 1
+                continue
+            plan.bytes += size
+        if self.deletion != DELETE_KEEP:
+            plan.deleted = sorted(path for path in target_files if not path in source_files)
+            # Deepest first so that folders are empty when they are removed
+            plan.deleted_folders = sorted((path for path in target_folders if not path in source_folders),
+                                          key=lambda path: path.count(os.sep), reverse=True)
+        return plan
+
+    def run(self, dry_run=False):
+        ''' Plan and, unless dry_run, apply the plan. Returns a MTPSyncReport '''
+        start = time.time()
+        plan = self.plan()
+        report = MTPSyncReport(plan, dry_run)
+        if not dry_run:
+            for path in plan.folders:
+                self.__mkdir(path, report)
+            for path in plan.added + plan.updated:
+                err = self.__copy(path)
+                if err == 0:
+                    report.copied += 1
+                else:
+                    report.errors.append((path, err))
+            for path in plan.deleted:
+                self.__delete(path, False, report)
+            for path in plan.deleted_folders:
+                self.__delete(path, True, report)
+        report.seconds = time.time() - start
+        self.log.info(str(report))
+        return report
+
+    def __device_tree(self):
+        ''' ({relative folder paths}, {relative file path: (size, mtime)}) from the cached listings '''
+        folder = self.mtp.get_path(self.device_path)
+        if folder is None:
+            if self.direction == UPLOAD:
+                return set(), {}
+            raise FileNotFoundError(self.device_path)
+        if not folder.is_directory():
+            raise NotADirectoryError(self.device_path)
+        folders, files = list_tree(self.mtp, folder)
+        return set(path for _, path in folders), \
+            dict((path, (entry.get_length(), entry.get_timestamp())) for entry, path in files)
+
+    def __local_tree(self):
+        folders, files = set(), {}
+        if not os.path.isdir(self.local_path):
+            if self.direction == DOWNLOAD:
+                return folders, files
+            raise NotADirectoryError(self.local_path)
+        trash = os.path.abspath(self.trash)
+        for dirpath, dirnames, filenames in os.walk(self.local_path):
+            dirnames[:] = [name for name in dirnames if os.path.abspath(os.path.join(dirpath, name)) != trash]
+            relpath = os.path.relpath(dirpath, self.local_path)
+            relpath = '' if relpath == os.curdir else relpath
+            folders.update(os.path.join(relpath, name) for name in dirnames)
+            for name in filenames:
+                st = os.stat(os.path.join(dirpath, name))
+                files[os.path.join(relpath, name)] = (st.st_size, int(st.st_mtime))
+        return folders, files
+
+    def __mkdir(self, path, report):
+        if self.direction == DOWNLOAD:
+            os.makedirs(os.path.join(self.local_path, path), exist_ok=True)
+        elif not self.mtp.mkdir(os.path.join(self.device_path, path)):
+            report.errors.append((path, errno.EIO))
+
+    def __copy(self, path):
+        device = os.path.join(self.device_path, path)
+        local = os.path.join(self.local_path, path)
+        if self.direction == UPLOAD:
+            try:
+                return self.mtp.executor.call(self.mtp.copy_to, local, device,
+                                              timestamp=int(os.path.getmtime(local)), priority=self.priority)
+            except OSError as e:
+                return e.errno if not e.errno is None else errno.EIO
+        # Download next to the target and rename so an interrupted sync never leaves a truncated file
+        entry = self.mtp.get_path(device)
+        if entry is None:
+            return errno.ENOENT
+        os.makedirs(os.path.dirname(local) or os.curdir, exist_ok=True)
+        fd, temp = tempfile.mkstemp(prefix='.pymtpfs-', dir=os.path.dirname(local) or os.curdir)
+        try:
+            err = self.mtp.copy_from(device, fd, priority=self.priority)
+            if err == 0:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        if err != 0:
+            os.remove(temp)
+            return err
+        os.utime(temp, (entry.get_timestamp(), entry.get_timestamp()))
+        os.replace(temp, local)
+        return 0
+
+    def __delete(self, path, is_folder, report):
+        if self.direction == UPLOAD:
+            device = os.path.join(self.device_path, path)
+            ok = self.mtp.rmdir(device) if is_folder else self.mtp.rm(device)
+            if not ok:
+                report.errors.append((path, errno.EIO))
+                return
+        else:
+            local = os.path.join(self.local_path, path)
+            try:
+                if self.deletion == DELETE_TRASH:
+                    if not is_folder or len(os.listdir(local)) > 0:
+                        trashed = os.path.join(self.trash, path)
+                        os.makedirs(os.path.dirname(trashed), exist_ok=True)
+                        shutil.move(local, trashed)
+                    else:
+                        os.rmdir(local)
+                elif is_folder:
+                    os.rmdir(local)
+                else:
+                    os.remove(local)
+            except OSError as e:
+                report.errors.append((path, e.errno))
+                return
+        report.deleted += 1
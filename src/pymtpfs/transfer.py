@@ -0,0 +1,162 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Progress tracking and stall detection for device transfers. libmtp reports progress through a callback, which
+is also the only way to make it stop a transfer. A transfer that hangs inside a USB call makes no callbacks at
+all, so a watchdog thread checks the running transfers as well: it marks a stalled transfer as timed out and
+tells whoever waits on it, and libmtp is told to stop at its next callback. The USB call that hung itself only
+returns at libusb's own timeout.
+'''
+
+import threading
+import time
+import weakref
+from ctypes import CFUNCTYPE, c_int, c_uint64, c_void_p
+
+from stats import MTPTransferRecord
+
+STALL_SECONDS = 2.0  # A gap this long between progress updates counts as a stall
+WATCHDOG_INTERVAL = 1.0  # Seconds between the watchdog's checks of the running transfers
+
+PROGRESS_FUNC_P = CFUNCTYPE(c_int, c_uint64, c_uint64, c_void_p)
+
+
+class MTPStallWatchdog:
+    '''
+    Checks the watched MTPTransferProgress objects every interval seconds on a daemon thread, which only runs
+    while there is something to watch.
+    '''
+
+    def __init__(self, interval=WATCHDOG_INTERVAL):
+        self.interval = interval
+        self.watched = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, progress):
+        with self.lock:
+            self.watched.add(progress)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name="pymtpfs-watchdog")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, progress):
+        with self.lock:
+            self.watched.discard(progress)
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                watched = list(self.watched)
+                if len(watched) == 0:
+                    self.thread = None
+                    return
+            for progress in watched:
+                progress.check()
+
+
+WATCHDOG = MTPStallWatchdog()
+
+
+class MTPTransferProgress:
+    '''
+    libmtp progress callback for a transfer. Stops the transfer once no bytes have moved for stall_timeout
+    seconds, its deadline (if any) has passed or cancel() was called. Once timed out a transfer stays timed out
+    until start() is called again. Between start() and record() the transfer is also checked by the watchdog,
+    which calls on_stall() when it finds the transfer timed out. on_progress(sent, total) is called for every
+    update, on the thread running the transfer. Also times the transfer: time to first byte and stalls (gaps
+    of STALL_SECONDS or more between updates).
+    '''
+
+    def __init__(self, timeout=None, on_progress=None, on_stall=None, clock=time.time, watchdog=WATCHDOG):
+        self.deadline = None
+        self.stall_timeout = None
+        self.timed_out = False
+        self.stalled_out = False  # timed_out because no bytes moved for stall_timeout seconds
+        self.cancelled = False
+        self.sent = 0
+        self.total = 0
+        self.on_progress = on_progress
+        self.on_stall = on_stall
+        self.clock = clock
+        self.watchdog = watchdog
+        self.lock = threading.Lock()
+        self.callback = PROGRESS_FUNC_P(self.__progress)
+        self.started = None
+        self.first_byte = None
+        self.last_update = None
+        self.stalls = 0
+        self.stalled = 0.0
+        self.moved = None  # When the byte count last changed
+        self.start(timeout)
+
+    def start(self, timeout, stall_timeout=None):
+        now = self.clock()
+        with self.lock:
+            if self.started is None:
+                self.started = now
+            self.moved = now
+            self.timed_out = self.stalled_out = False
+            if not timeout is None:
+                self.deadline = now + timeout
+            if not stall_timeout is None:
+                self.stall_timeout = stall_timeout
+            watch = not self.deadline is None or not self.stall_timeout is None
+        if watch and not self.watchdog is None:
+            self.watchdog.watch(self)
+
+    def record(self, direction, path, ok):
+        ''' A MTPTransferRecord for the transfer so far. The transfer is no longer watched '''
+        if not self.watchdog is None:
+            self.watchdog.unwatch(self)
+        now = self.clock()
+        return MTPTransferRecord(direction, path, self.sent, now - self.started,
+                                 None if self.first_byte is None else self.first_byte - self.started,
+                                 self.stalls, self.stalled, ok)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def update(self, sent, total):
+        ''' Record progress. Returns False if the transfer should stop '''
+        now = self.clock()
+        with self.lock:
+            if sent > 0 and self.first_byte is None:
+                self.first_byte = now
+            elif not self.last_update is None and now - self.last_update >= STALL_SECONDS:
+                self.stalls += 1
+                self.stalled += now - self.last_update
+            self.last_update = now
+            if sent != self.sent:
+                self.moved = now
+            self.sent = sent
+            self.total = total
+            was_timed_out = self.timed_out
+            timed_out = self.__expire(now)
+        if not self.on_progress is None:
+            self.on_progress(sent, total)
+        if timed_out and not was_timed_out and not self.on_stall is None:
+            self.on_stall()
+        return not (self.cancelled or timed_out)
+
+    def check(self):
+        ''' Apply the stall timeout and deadline without an update. Returns False if the transfer should stop '''
+        with self.lock:
+            was_timed_out = self.timed_out
+            timed_out = self.__expire(self.clock())
+        if timed_out and not was_timed_out and not self.on_stall is None:
+            self.on_stall()
+        return not (self.cancelled or timed_out)
+
+    def __expire(self, now):
+        # Called with the lock held
+        if not self.timed_out:
+            if not self.stall_timeout is None and now - self.moved > self.stall_timeout:
+                self.timed_out = self.stalled_out = True
+            elif not self.deadline is None and now > self.deadline:
+                self.timed_out = True
+        return self.timed_out
+
+    def __progress(self, sent, total, data):
+        return 0 if self.update(sent, total) else 1
@@ -0,0 +1,194 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Bulk copies of whole folders between a MTP device and the host, without going through the FUSE mount.
+Files are transferred straight to their final location and the host side work of one file (fsync, close,
+setting the modification time) runs on a separate thread while the next file is on the USB bus.
+'''
+
+import errno
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from executor import METADATA, BACKGROUND
+
+
+class MTPManifestEntry:
+    __slots__ = ('source', 'target', 'size', 'transfer_seconds', 'host_seconds', 'error')
+
+    def __init__(self, source, target, size):
+        self.source = source
+        self.target = target
+        self.size = size
+        self.transfer_seconds = 0.0
+        self.host_seconds = 0.0  # fsync/close/utime for downloads, read ahead for uploads
+        self.error = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in MTPManifestEntry.__slots__)
+
+
+class MTPManifest:
+    ''' Result of a tree copy: one MTPManifestEntry per file plus the folders created on the target side '''
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.started = time.time()
+        self.seconds = 0.0
+        self.folders = []
+        self.files = []
+
+    def failed(self):
+        return [entry for entry in self.files if entry.error != 0]
+
+    def bytes(self):
+        return sum(entry.size for entry in self.files if entry.error == 0)
+
+    def as_dict(self):
+        return {'source': self.source, 'target': self.target, 'started': self.started, 'seconds': self.seconds,
+                'bytes': self.bytes(), 'folders': self.folders, 'files': [entry.as_dict() for entry in self.files]}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def __str__(self):
+        return "%s -> %s: %d files (%d failed), %d folders, %d bytes in %.1fs" % \
+               (self.source, self.target, len(self.files), len(self.failed()), len(self.folders), self.bytes(),
+                self.seconds)
+
+
+def list_tree(mtp, folder, priority=METADATA):
+    '''
+    All (folder, relative path) and (file, relative path) pairs below folder, breadth first, listing every
+    folder once
+    '''
+    folders, files = [], []
+    queue = [(folder, '')]
+    while len(queue) > 0:
+        dir, relpath = queue.pop(0)
+        if dir.must_refresh:
+            mtp.executor.call(dir.refresh, priority=priority)
+        for child in dir.get_directories():
+            childpath = os.path.join(relpath, child.get_name())
+            folders.append((child, childpath))
+            queue.append((child, childpath))
+        for child in dir.get_files():
+            files.append((child, os.path.join(relpath, child.get_name())))
+    return folders, files
+
+
+def download_tree(mtp, source, target, priority=BACKGROUND, fsync=True):
+    ''' Copy the device folder source into the host directory target. Returns a MTPManifest '''
+    log = logging.getLogger("pymtpfs")
+    manifest = MTPManifest(source, target)
+    folder = mtp.get_path(source)
+    if folder is None or not folder.is_directory():
+        raise NotADirectoryError(source)
+    folders, files = list_tree(mtp, folder)
+    os.makedirs(target, exist_ok=True)
+    for dir, relpath in folders:
+        os.makedirs(os.path.join(target, relpath), exist_ok=True)
+        manifest.folders.append(relpath)
+    with ThreadPoolExecutor(max_workers=1) as host:
+        for entry, relpath in files:
+            record = MTPManifestEntry(entry.get_path(), os.path.join(target, relpath), entry.get_length())
+            manifest.files.append(record)
+            try:
+                fd = os.open(record.target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            except OSError as e:
+                log.error("Could not create %s (%s)" % (record.target, e.strerror))
+                record.error = e.errno
+                continue
+            start = time.time()
+            record.error = mtp.copy_from(record.source, fd, priority=priority)
+            record.transfer_seconds = time.time() - start
+            host.submit(_finish_download, record, fd, entry.get_timestamp(), fsync)
+    manifest.seconds = time.time() - manifest.started
+    log.info(str(manifest))
+    return manifest
+
+
+def _finish_download(record, fd, mtime, fsync):
+    start = time.time()
+    try:
+        if fsync and record.error == 0:
+            os.fsync(fd)
+    except OSError as e:
+        record.error = e.errno
+    finally:
+        os.close(fd)
+    if record.error == 0:
+        os.utime(record.target, (mtime, mtime))
+    else:
+        try:
+            os.remove(record.target)
+        except OSError:
+            pass
+    record.host_seconds = time.time() - start
+
+
+def upload_tree(mtp, source, target, priority=BACKGROUND):
+    '''
+    Copy the host directory source into the device folder target, creating missing folders. While a file
+    is sent the next one is read ahead into the page cache. Returns a MTPManifest.
+    '''
+    log = logging.getLogger("pymtpfs")
+    manifest = MTPManifest(source, target)
+    folders, files = [], []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, source)
+        relpath = '' if relpath == os.curdir else relpath
+        folders.extend(os.path.join(relpath, name) for name in dirnames)
+        files.extend(os.path.join(relpath, name) for name in sorted(filenames))
+    for relpath in [''] + folders:
+        path = os.path.join(target, relpath).rstrip(os.sep)
+        entry = mtp.get_path(path)
+        if entry is None:
+            if not mtp.mkdir(path):
+                raise OSError(errno.EIO, "Could not create folder %s" % (path,))
+            if relpath != '':
+                manifest.folders.append(relpath)
+        elif not entry.is_directory():
+            raise NotADirectoryError(path)
+    with ThreadPoolExecutor(max_workers=1) as host:
+        ahead = None
+        for i, relpath in enumerate(files):
+            local = os.path.join(source, relpath)
+            record = MTPManifestEntry(local, os.path.join(target, relpath), 0)
+            manifest.files.append(record)
+            if not ahead is None:
+                record.host_seconds = ahead.result()
+            if i + 1 < len(files):
+                ahead = host.submit(_read_ahead, os.path.join(source, files[i + 1]))
+            start = time.time()
+            try:
+                record.size = os.path.getsize(local)
+                record.error = mtp.executor.call(mtp.copy_to, local, record.target,
+                                                 timestamp=int(os.path.getmtime(local)), priority=priority)
+            except OSError as e:
+                log.error("Could not upload %s (%s)" % (local, e.strerror))
+                record.error = e.errno if not e.errno is None else errno.EIO
+            record.transfer_seconds = time.time() - start
+    manifest.seconds = time.time() - manifest.started
+    log.info(str(manifest))
+    return manifest
+
+
+def _read_ahead(path):
+    ''' Ask the kernel to start reading the next file while the current one is sent. Returns the seconds taken '''
+    start = time.time()
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+    return time.time() - start
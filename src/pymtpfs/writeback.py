@@ -0,0 +1,164 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Write-back upload queue. Files written through the mount are handed over when they are released and uploaded
+on a background thread, so closing a file does not wait for the device.
+'''
+
+import errno
+import logging
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+WRITEBACK_MAX_BYTES = 512 * 1024 * 1024  # Staged bytes waiting for upload before release() blocks
+
+
+class MTPPendingUpload:
+    __slots__ = ('path', 'localpath', 'size', 'mtime', 'queued')
+
+    def __init__(self, path, localpath, size, mtime):
+        self.path = path
+        self.localpath = localpath
+        self.size = size
+        self.mtime = mtime
+        self.queued = time.time()
+
+    def get_attributes(self):
+        ''' Attributes of the file as it will be once uploaded '''
+        return {'st_atime': self.mtime, 'st_ctime': self.mtime, 'st_gid': os.getgid(),
+                'st_mode': stat.S_IFREG | 0o755, 'st_mtime': self.mtime, 'st_nlink': 1,
+                'st_size': self.size, 'st_uid': os.getuid()}
+
+
+class MTPWriteBack:
+    '''
+    Uploads staged local files to the device in the order they were queued. A path queued again before its
+    upload started replaces the earlier version, which is never sent. Staged files are owned by the queue and
+    removed once uploaded. When more than max_bytes are staged, enqueue() blocks until uploads have freed
+    enough. Upload errors are kept per path and returned by the next wait() for that path.
+    '''
+
+    def __init__(self, mtp, max_bytes=WRITEBACK_MAX_BYTES):
+        self.mtp = mtp
+        self.max_bytes = max_bytes
+        self.queue = OrderedDict()  # device path -> MTPPendingUpload
+        self.uploading = None
+        self.staged = 0
+        self.errors = {}  # device path -> errno of the last failed upload
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.log = logging.getLogger("pymtpfs")
+        self.thread = threading.Thread(target=self.__run, name="pymtpfs-writeback")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, path, localpath):
+        ''' Queue the staged file localpath for upload to path. The queue removes localpath when done '''
+        st = os.stat(localpath)
+        upload = MTPPendingUpload(path, localpath, st.st_size, int(st.st_mtime))
+        with self.condition:
+            # Backpressure: wait for room unless nothing else is staged, so a single large file still goes
+            while self.staged > 0 and self.staged + upload.size > self.max_bytes and not self.stopped:
+                self.condition.wait()
+            replaced = self.queue.pop(path, None)
+            if not replaced is None:
+                self.staged -= replaced.size
+                self.__remove(replaced.localpath)
+            self.errors.pop(path, None)
+            self.queue[path] = upload
+            self.staged += upload.size
+            self.condition.notify_all()
+
+    def pending(self, path):
+        ''' The MTPPendingUpload queued or being uploaded for path, if any '''
+        with self.condition:
+            upload = self.queue.get(path)
+            if upload is None and not self.uploading is None and self.uploading.path == path:
+                upload = self.uploading
+            return upload
+
+    def set_mtime(self, path, mtime):
+        ''' Fold a new modification time into the queued upload of path. False if no upload of path is queued '''
+        with self.condition:
+            upload = self.queue.get(path)
+            if upload is None:
+                return False
+            upload.mtime = int(mtime)
+            try:
+                os.utime(upload.localpath, (upload.mtime, upload.mtime))
+            except OSError:
+                pass
+            return True
+
+    def wait(self, path=None):
+        ''' Block until path (or, if None, everything) has been uploaded. Returns 0 or the upload error '''
+        with self.condition:
+            while self.__busy(path):
+                self.condition.wait()
+            if path is None:
+                errors = list(self.errors.values())
+                self.errors.clear()
+                return errors[0] if len(errors) > 0 else 0
+            return self.errors.pop(path, 0)
+
+    def discard(self, path):
+        ''' Drop a queued upload of path (for instance because path is being removed) and wait for one in progress '''
+        with self.condition:
+            upload = self.queue.pop(path, None)
+            if not upload is None:
+                self.staged -= upload.size
+                self.__remove(upload.localpath)
+                self.condition.notify_all()
+            while self.__busy(path):
+                self.condition.wait()
+            self.errors.pop(path, None)
+
+    def stop(self):
+        ''' Upload everything still queued, then stop the upload thread. Returns 0 or an upload error '''
+        err = self.wait()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        return err
+
+    def __busy(self, path):
+        if path is None:
+            return len(self.queue) > 0 or not self.uploading is None
+        return path in self.queue or (not self.uploading is None and self.uploading.path == path)
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.stopped:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    return
+                _, upload = self.queue.popitem(last=False)
+                self.uploading = upload
+            try:
+                err = self.mtp.copy_to(upload.localpath, upload.path, timestamp=upload.mtime)
+            except Exception:
+                self.log.exception("Write-back upload of %s failed" % (upload.path,))
+                err = errno.EIO
+            with self.condition:
+                self.uploading = None
+                self.staged -= upload.size
+                if err == 0:
+                    self.__remove(upload.localpath)
+                else:
+                    self.errors[upload.path] = err
+                    if upload.path in self.queue:
+                        self.__remove(upload.localpath)  # Superseded by a newer version
+                    else:
+                        self.log.error("Write-back upload of %s failed (%d), the data is kept in %s" %
+                                       (upload.path, err, upload.localpath))
+                self.condition.notify_all()
+
+    def __remove(self, localpath):
+        try:
+            os.remove(localpath)
+        except OSError:
+            pass
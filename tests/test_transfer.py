@@ -0,0 +1,161 @@
+'''
+License: Apache V2 (http://www.apache.org/licenses/LICENSE-2.0.txt)
+Stall detection of MTPTransferProgress, with transfers that stall halfway.
+'''
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pymtpfs'))
+
+from transfer import MTPStallWatchdog, MTPTransferProgress, STALL_SECONDS
+
+SIZE = 100 * 1024 * 1024
+CHUNK = 1024 * 1024
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class StallTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stalls = []
+        self.progress = MTPTransferProgress(on_stall=lambda: self.stalls.append(self.clock()), clock=self.clock,
+                                            watchdog=None)
+        self.progress.start(None, stall_timeout=10)
+
+    def transfer_half(self, seconds_per_chunk=0.1):
+        sent = 0
+        while sent < SIZE // 2:
+            self.clock.advance(seconds_per_chunk)
+            sent += CHUNK
+            self.assertTrue(self.progress.update(sent, SIZE))
+        return sent
+
+    def test_stall_halfway_found_by_check(self):
+        # libmtp makes no more callbacks: only the watchdog's check() can notice
+        sent = self.transfer_half()
+        self.clock.advance(9)
+        self.assertTrue(self.progress.check())
+        self.assertFalse(self.progress.timed_out)
+        self.clock.advance(2)
+        self.assertFalse(self.progress.check())
+        self.assertTrue(self.progress.timed_out)
+        self.assertTrue(self.progress.stalled_out)
+        self.assertEqual(self.stalls, [self.clock()])
+        # The transfer stays aborted even if bytes arrive late, and on_stall is not repeated
+        self.assertFalse(self.progress.update(sent + CHUNK, SIZE))
+        self.assertEqual(self.progress.callback(sent + 2 * CHUNK, SIZE, None), 1)
+        self.assertFalse(self.progress.check())
+        self.assertEqual(len(self.stalls), 1)
+
+    def test_stall_halfway_found_by_update(self):
+        # libmtp keeps calling back but the byte count does not move
+        sent = self.transfer_half()
+        for _ in range(10):
+            self.clock.advance(1)
+            self.assertTrue(self.progress.update(sent, SIZE))
+        self.clock.advance(1)
+        self.assertFalse(self.progress.update(sent, SIZE))
+        self.assertTrue(self.progress.stalled_out)
+        self.assertEqual(len(self.stalls), 1)
+
+    def test_slow_transfer_is_not_aborted(self):
+        sent = self.transfer_half(seconds_per_chunk=9)
+        while sent < SIZE:
+            self.clock.advance(9)
+            sent += CHUNK
+            self.assertTrue(self.progress.update(sent, SIZE))
+        self.assertFalse(self.progress.timed_out)
+        self.assertEqual(self.stalls, [])
+        # Every gap was longer than STALL_SECONDS so each counts in the statistics
+        record = self.progress.record('download', '/Phone/video.mp4', True)
+        self.assertEqual(record.stalls, SIZE // CHUNK - 1)
+        self.assertEqual(record.bytes, SIZE)
+        self.assertGreaterEqual(record.stalled, (SIZE // CHUNK - 1) * STALL_SECONDS)
+
+    def test_start_resumes_after_stall(self):
+        sent = self.transfer_half()
+        self.clock.advance(11)
+        self.assertFalse(self.progress.check())
+        # A resumed transfer (after reconnecting) gets a fresh stall timer
+        self.progress.start(None)
+        self.assertFalse(self.progress.timed_out)
+        self.clock.advance(5)
+        self.assertTrue(self.progress.update(sent + CHUNK, SIZE))
+        self.assertTrue(self.progress.check())
+
+    def test_deadline(self):
+        self.progress.start(30)
+        sent = 0
+        for _ in range(29):
+            self.clock.advance(1)
+            sent += CHUNK
+            self.assertTrue(self.progress.update(sent, SIZE))
+        self.clock.advance(2)
+        self.assertFalse(self.progress.update(sent + CHUNK, SIZE))
+        self.assertTrue(self.progress.timed_out)
+        self.assertFalse(self.progress.stalled_out)
+
+    def test_cancel(self):
+        self.transfer_half()
+        self.progress.cancel()
+        self.assertFalse(self.progress.check())
+        self.assertFalse(self.progress.timed_out)
+        self.assertEqual(self.stalls, [])
+
+
+class WatchdogTest(unittest.TestCase):
+    def test_hung_transfer_is_aborted(self):
+        ''' A transfer thread that hangs halfway inside a "USB call", making no callbacks at all '''
+        watchdog = MTPStallWatchdog(interval=0.02)
+        stalled = threading.Event()
+        hang = threading.Event()
+        progress = MTPTransferProgress(on_stall=stalled.set, watchdog=watchdog)
+        progress.start(None, stall_timeout=0.2)
+        results = []
+
+        def transfer():
+            sent = 0
+            while sent < SIZE:
+                if sent == SIZE // 2:
+                    hang.wait(10)
+                sent += CHUNK
+                if progress.callback(sent, SIZE, None) != 0:
+                    break
+            results.append(sent)
+
+        thread = threading.Thread(target=transfer)
+        thread.start()
+        self.assertTrue(stalled.wait(5))
+        self.assertTrue(progress.stalled_out)
+        self.assertTrue(thread.is_alive())  # Still stuck in the call, only told to stop at the next callback
+        hang.set()
+        thread.join(5)
+        self.assertEqual(results, [SIZE // 2 + CHUNK])
+
+    def test_finished_transfer_is_not_watched(self):
+        watchdog = MTPStallWatchdog(interval=0.02)
+        stalled = threading.Event()
+        progress = MTPTransferProgress(on_stall=stalled.set, watchdog=watchdog)
+        progress.start(None, stall_timeout=0.1)
+        progress.update(SIZE, SIZE)
+        progress.record('upload', '/Phone/a.jpg', True)
+        self.assertFalse(stalled.wait(0.5))
+        self.assertFalse(progress.timed_out)
+        self.assertEqual(len(watchdog.watched), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()